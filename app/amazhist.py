@@ -13,29 +13,31 @@ Options:
 """
 
 import logging
-import random
 
 import store_amazon.handle
-import store_amazon.crawler
-import store_amazon.order_history
-import local_lib.selenium_util
 
 NAME = "amazhist"
 VERSION = "0.1.0"
 
 
 def execute_fetch(handle):
+    # NOTE: Selenium 関係は読み込みに時間がかかるので，必要になった時に import する
+    import store_amazon.crawler
+    import local_lib.selenium_util
+
     try:
         store_amazon.crawler.fetch_order_item_list(handle)
-    except:
+    except Exception:
         driver, wait = store_amazon.handle.get_selenium_driver(handle)
         local_lib.selenium_util.dump_page(
-            driver, int(random.random() * 100), store_amazon.handle.get_debug_dir_path(handle)
+            driver, store_amazon.handle.get_dump_index(handle), store_amazon.handle.get_debug_dir_path(handle)
         )
         raise
 
 
 def execute(config, is_export_mode=False, is_need_thumb=True):
+    import store_amazon.order_history
+
     handle = store_amazon.handle.create(config)
 
     try:
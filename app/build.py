@@ -7,18 +7,24 @@ Usage:
   build.py
 """
 
+import os
+import pathlib
 import subprocess
 import amazhist
 
 JOBS = 16
 
+# NOTE: C コンパイル結果を使い回せるよう，キャッシュの場所を固定する
+CACHE_DIR = pathlib.Path.home() / ".cache" / "nuitka-amazhist"
+
 
 def build():
     build_command = (
         "poetry run nuitka3 --follow-imports --include-package-data=selenium "
         "--product-name={name} --file-version={version} --product-version={version} "
-        "--windows-icon-from-ico={icon_image} --macos-app-icon={icon_image} --jobs={jobs} "
-        "--assume-yes-for-download --standalone --onefile --output-dir=build "
+        "--windows-icon-from-ico={icon_image} --macos-app-icon={icon_image} --jobs={jobs} --lto=yes "
+        "--include-package=store_amazon --include-package=local_lib "
+        "--assume-yes-for-downloads --remove-output --standalone --onefile --output-dir=build "
         "--script-name=app/amazhist.py "
     ).format(
         jobs=JOBS,
@@ -27,7 +33,7 @@ def build():
         icon_image="img/icon.png",
     )
 
-    subprocess.call(build_command, shell=True)
+    subprocess.call(build_command, shell=True, env=os.environ | {"NUITKA_CACHE_DIR": str(CACHE_DIR)})
 
 
 if __name__ == "__main__":
@@ -1,129 +1,161 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import io
+import functools
+import shutil
+
+import openpyxl.cell
 import openpyxl.utils
 import openpyxl.styles
 import openpyxl.drawing.image
+import PIL.Image
+
+# NOTE: 縮小した画像を置く，画像のディレクトリ内のサブディレクトリ名
+RESIZED_DIR_NAME = "resized"
 
 
 def gen_text_pos(row, col):
-    return "{col}{row}".format(
-        row=row,
-        col=openpyxl.utils.get_column_letter(col),
-    )
+    return f"{openpyxl.utils.get_column_letter(col)}{row}"
 
 
-def set_header_cell_style(sheet, row, col, value, width, style):
-    sheet.cell(row, col).value = value
-    sheet.cell(row, col).style = "Normal"
-    sheet.cell(row, col).border = style["border"]
-    sheet.cell(row, col).fill = style["fill"]
+def append_row(sheet, cell_map):
+    # NOTE: write_only モードでは行単位で追記する必要があるので，列番号順に並べる
+    sheet.append([cell_map.get(col) for col in range(1, max(cell_map.keys(), default=0) + 1)])
 
-    if width is not None:
-        sheet.column_dimensions[openpyxl.utils.get_column_letter(col)].width = width
 
+def gen_header_cell(sheet, value, style):
+    cell = openpyxl.cell.WriteOnlyCell(sheet, value=value)
+    cell.style = "Normal"
+    cell.border = style["border"]
+    cell.fill = style["fill"]
 
-def insert_table_header(sheet, row, sheet_def, base_style):
-    for key in sheet_def["TABLE_HEADER"]["col"].keys():
-        col = sheet_def["TABLE_HEADER"]["col"][key]["pos"]
-        if "width" in sheet_def["TABLE_HEADER"]["col"][key]:
-            width = sheet_def["TABLE_HEADER"]["col"][key]["width"]
-        else:
-            width = None
+    return cell
+
+
+def insert_table_header(sheet, sheet_def, base_style):
+    cell_map = {}
+    for key, cell_def in sheet_def["TABLE_HEADER"]["col"].items():
+        col = cell_def["pos"]
 
         if key == "category":
-            for i in range(sheet_def["TABLE_HEADER"]["col"][key]["length"]):
-                set_header_cell_style(
-                    sheet,
-                    row,
-                    col + i,
-                    sheet_def["TABLE_HEADER"]["col"][key]["label"] + " ({i})".format(i=i + 1),
-                    width,
-                    base_style,
+            for i in range(cell_def["length"]):
+                cell_map[col + i] = gen_header_cell(
+                    sheet, cell_def["label"] + " ({i})".format(i=i + 1), base_style
                 )
         else:
-            set_header_cell_style(
-                sheet, row, col, sheet_def["TABLE_HEADER"]["col"][key]["label"], width, base_style
-            )
+            cell_map[col] = gen_header_cell(sheet, cell_def["label"], base_style)
 
+    append_row(sheet, cell_map)
 
-def gen_item_cell_style(base_style, cell_def):
-    style = base_style.copy()
 
-    if "format" in cell_def:
-        style["text_format"] = cell_def["format"]
+def gen_item_cell_style_map(sheet_def, base_style):
+    # NOTE: スタイルは列毎に共通なので，セル毎に作らずに最初にまとめて作っておく
+    style_map = {}
+    for key, cell_def in sheet_def["TABLE_HEADER"]["col"].items():
+        style = {
+            "border": base_style["border"],
+            "alignment": openpyxl.styles.Alignment(wrap_text=cell_def.get("wrap", False), vertical="top"),
+        }
 
-    if "wrap" in cell_def:
-        style["text_wrap"] = cell_def["wrap"]
-    else:
-        style["text_wrap"] = False
+        if "format" in cell_def:
+            style["text_format"] = cell_def["format"]
+
+        style_map[key] = style
 
-    return style
+    return style_map
 
 
-def set_item_cell_style(sheet, row, col, value, style):
-    sheet.cell(row, col).value = value
-    sheet.cell(row, col).style = "Normal"
-    sheet.cell(row, col).border = style["border"]
-    sheet.cell(row, col).alignment = openpyxl.styles.Alignment(wrap_text=style["text_wrap"], vertical="top")
+def gen_item_cell(sheet, value, style):
+    cell = openpyxl.cell.WriteOnlyCell(sheet, value=value)
+    cell.style = "Normal"
+    cell.border = style["border"]
+    cell.alignment = style["alignment"]
 
     if "text_format" in style:
-        sheet.cell(row, col).number_format = style["text_format"]
+        cell.number_format = style["text_format"]
 
+    return cell
 
-def insert_table_item(sheet, row, item, is_need_thumb, thumb_path, sheet_def, base_style):
-    for key in sheet_def["TABLE_HEADER"]["col"].keys():
-        col = sheet_def["TABLE_HEADER"]["col"][key]["pos"]
 
-        cell_style = gen_item_cell_style(base_style, sheet_def["TABLE_HEADER"]["col"][key])
+def insert_table_item(sheet, row, item, is_need_thumb, thumb_path, sheet_def, style_map, image_cache):
+    cell_map = {}
+    for key, cell_def in sheet_def["TABLE_HEADER"]["col"].items():
+        col = cell_def["pos"]
+
+        cell_style = style_map[key]
 
         if key == "category":
-            for i in range(sheet_def["TABLE_HEADER"]["col"][key]["length"]):
+            for i in range(cell_def["length"]):
                 if i < len(item["category"]):
                     value = item[key][i]
                 else:
                     value = ""
-                set_item_cell_style(sheet, row, col + i, value, cell_style)
+                cell_map[col + i] = gen_item_cell(sheet, value, cell_style)
         elif key == "image":
-            sheet.cell(row, col).border = cell_style["border"]
+            cell_map[col] = openpyxl.cell.WriteOnlyCell(sheet)
+            cell_map[col].border = cell_style["border"]
             if is_need_thumb:
                 insert_table_cell_image(
                     sheet,
                     row,
                     col,
                     thumb_path,
-                    sheet_def["TABLE_HEADER"]["col"]["image"]["width"],
+                    cell_def["width"],
                     sheet_def["TABLE_HEADER"]["row"]["height"]["default"],
+                    image_cache,
                 )
         else:
-            if (
-                ("optional" in sheet_def["TABLE_HEADER"]["col"][key])
-                and sheet_def["TABLE_HEADER"]["col"][key]["optional"]
-                and (key not in item)
-            ):
+            if cell_def.get("optional", False) and (key not in item):
                 value = None
             else:
-                if "value" in sheet_def["TABLE_HEADER"]["col"][key]:
-                    value = sheet_def["TABLE_HEADER"]["col"][key]["value"]
-                elif "formal_key" in sheet_def["TABLE_HEADER"]["col"][key]:
-                    value = item[sheet_def["TABLE_HEADER"]["col"][key]["formal_key"]]
+                if "value" in cell_def:
+                    value = cell_def["value"]
+                elif "formal_key" in cell_def:
+                    value = item[cell_def["formal_key"]]
                 else:
                     value = item[key]
 
-                if "conv_func" in sheet_def["TABLE_HEADER"]["col"][key]:
-                    value = sheet_def["TABLE_HEADER"]["col"][key]["conv_func"](value)
+                if "conv_func" in cell_def:
+                    value = cell_def["conv_func"](value)
 
-            set_item_cell_style(sheet, row, col, value, cell_style)
+            cell_map[col] = gen_item_cell(sheet, value, cell_style)
 
-        if "link_func" in sheet_def["TABLE_HEADER"]["col"][key]:
-            sheet.cell(row, col).hyperlink = sheet_def["TABLE_HEADER"]["col"][key]["link_func"](item)
+        if "link_func" in cell_def:
+            cell_map[col].hyperlink = cell_def["link_func"](item)
 
+    append_row(sheet, cell_map)
 
-def insert_table_cell_image(sheet, row, col, thumb_path, cell_width, cell_height):
-    if (thumb_path is None) or (not thumb_path.exists()):
-        return
 
-    img = openpyxl.drawing.image.Image(thumb_path)
+def prepare_resized_dir(resized_dir):
+    # NOTE: セルの大きさが変わった場合，以前の大きさで縮小した画像は使わないので削除する
+    if resized_dir.parent.exists():
+        for path in resized_dir.parent.iterdir():
+            if path.is_dir() and (path != resized_dir):
+                shutil.rmtree(path)
+
+    resized_dir.mkdir(parents=True, exist_ok=True)
 
+
+def get_resized_image_path(image_path, width, height):
+    # NOTE: 元画像と混ざらないよう，縮小した画像は大きさ毎のサブディレクトリに置く
+    resized_dir = image_path.parent / RESIZED_DIR_NAME / "{width}x{height}".format(width=width, height=height)
+    if not resized_dir.exists():
+        prepare_resized_dir(resized_dir)
+
+    resized_path = resized_dir / image_path.name
+
+    # NOTE: 縮小済みの画像はキャッシュしておき，元画像が更新された場合のみ作り直す
+    if (not resized_path.exists()) or (resized_path.stat().st_mtime < image_path.stat().st_mtime):
+        with PIL.Image.open(image_path) as img:
+            img.thumbnail((width, height), PIL.Image.LANCZOS)
+            img.save(resized_path)
+
+    return resized_path
+
+
+# NOTE: セルの大きさは全行で共通なので，一度だけ計算する
+@functools.lru_cache(maxsize=None)
+def gen_image_geometry(cell_width, cell_height):
     # NOTE: マジックナンバー「8」は下記等を参考にして設定．(日本語フォントだと 8 が良さそう)
     # > In all honesty, I cannot tell you how many blogs and stack overflow answers
     # > I read before I stumbled across this magic number: 7.5
@@ -131,12 +163,24 @@ def insert_table_cell_image(sheet, row, col, thumb_path, cell_width, cell_height
     cell_width_pix = cell_width * 8
     cell_height_pix = openpyxl.utils.units.points_to_pixels(cell_height)
 
-    cell_width_emu = openpyxl.utils.units.pixels_to_EMU(cell_width_pix)
-    cell_height_emu = openpyxl.utils.units.pixels_to_EMU(cell_height_pix)
-
     margin_pix = 2
-    content_width_pix = cell_width_pix - (margin_pix * 2)
-    content_height_pix = cell_height_pix - (margin_pix * 2)
+
+    return {
+        "cell_width_emu": openpyxl.utils.units.pixels_to_EMU(cell_width_pix),
+        "cell_height_emu": openpyxl.utils.units.pixels_to_EMU(cell_height_pix),
+        "content_width_pix": cell_width_pix - (margin_pix * 2),
+        "content_height_pix": cell_height_pix - (margin_pix * 2),
+    }
+
+
+def load_cell_image(thumb_path, geometry):
+    content_width_pix = geometry["content_width_pix"]
+    content_height_pix = geometry["content_height_pix"]
+
+    # NOTE: 大きな画像をそのまま埋め込むとファイルサイズも処理時間も嵩むので，
+    # セルに収まるサイズに縮小したものを使う
+    data = get_resized_image_path(thumb_path, int(content_width_pix), int(content_height_pix)).read_bytes()
+    img = openpyxl.drawing.image.Image(io.BytesIO(data))
 
     content_ratio = content_width_pix / content_height_pix
     image_ratio = img.width / img.height
@@ -155,8 +199,30 @@ def insert_table_cell_image(sheet, row, col, thumb_path, cell_width, cell_height
     image_width_emu = openpyxl.utils.units.pixels_to_EMU(img.width)
     image_height_emu = openpyxl.utils.units.pixels_to_EMU(img.height)
 
-    col_offset_emu = (cell_width_emu - image_width_emu) / 2
-    row_offset_emu = (cell_height_emu - image_height_emu) / 2
+    return {
+        "data": data,
+        "width": img.width,
+        "height": img.height,
+        "col_offset_emu": (geometry["cell_width_emu"] - image_width_emu) / 2,
+        "row_offset_emu": (geometry["cell_height_emu"] - image_height_emu) / 2,
+    }
+
+
+def insert_table_cell_image(sheet, row, col, thumb_path, cell_width, cell_height, image_cache):
+    if (thumb_path is None) or ((thumb_path not in image_cache) and (not thumb_path.exists())):
+        return
+
+    # NOTE: 同じ商品は何度も出てくるので，読み込んだ画像と配置の計算結果は使い回す
+    if thumb_path not in image_cache:
+        image_cache[thumb_path] = load_cell_image(thumb_path, gen_image_geometry(cell_width, cell_height))
+    image_info = image_cache[thumb_path]
+
+    img = openpyxl.drawing.image.Image(io.BytesIO(image_info["data"]))
+    img.width = image_info["width"]
+    img.height = image_info["height"]
+
+    col_offset_emu = image_info["col_offset_emu"]
+    row_offset_emu = image_info["row_offset_emu"]
 
     marker_1 = openpyxl.drawing.spreadsheet_drawing.AnchorMarker(
         col=col - 1, row=row - 1, colOff=col_offset_emu, rowOff=row_offset_emu
@@ -170,7 +236,25 @@ def insert_table_cell_image(sheet, row, col, thumb_path, cell_width, cell_height
     sheet.add_image(img)
 
 
-def setting_table_view(sheet, sheet_def, row_last, is_hidden):
+def setting_table_column(sheet, sheet_def):
+    for key, cell_def in sheet_def["TABLE_HEADER"]["col"].items():
+        if "width" not in cell_def:
+            continue
+
+        col = cell_def["pos"]
+        width = cell_def["width"]
+
+        if key == "category":
+            for i in range(cell_def["length"]):
+                sheet.column_dimensions[openpyxl.utils.get_column_letter(col + i)].width = width
+        else:
+            sheet.column_dimensions[openpyxl.utils.get_column_letter(col)].width = width
+
+
+def setting_table_view(sheet, sheet_def, is_hidden):
+    # NOTE: write_only モードでは，行を書き込む前に設定しておく必要がある
+    setting_table_column(sheet, sheet_def)
+
     sheet.column_dimensions.group(
         openpyxl.utils.get_column_letter(sheet_def["TABLE_HEADER"]["col"]["image"]["pos"]),
         openpyxl.utils.get_column_letter(sheet_def["TABLE_HEADER"]["col"]["image"]["pos"]),
@@ -182,14 +266,20 @@ def setting_table_view(sheet, sheet_def, row_last, is_hidden):
         sheet_def["TABLE_HEADER"]["col"]["price"]["pos"] + 1,
     )
 
+    sheet.sheet_view.showGridLines = False
+
+
+def setting_table_filter(sheet, sheet_def, row_last):
+    col_def_list = sheet_def["TABLE_HEADER"]["col"].values()
+
+    # NOTE: 複数列にまたがる項目 (category) は，その最後の列まで含める
+    col_first = min(cell_def["pos"] for cell_def in col_def_list)
+    col_last = max(cell_def["pos"] + cell_def.get("length", 1) - 1 for cell_def in col_def_list)
+
     sheet.auto_filter.ref = "{start}:{end}".format(
-        start=gen_text_pos(
-            sheet_def["TABLE_HEADER"]["row"]["pos"],
-            min(map(lambda x: x["pos"], sheet_def["TABLE_HEADER"]["col"].values())),
-        ),
-        end=gen_text_pos(row_last, max(map(lambda x: x["pos"], sheet_def["TABLE_HEADER"]["col"].values()))),
+        start=gen_text_pos(sheet_def["TABLE_HEADER"]["row"]["pos"], col_first),
+        end=gen_text_pos(row_last, col_last),
     )
-    sheet.sheet_view.showGridLines = False
 
 
 def generate_list_sheet(
@@ -211,10 +301,17 @@ def generate_list_sheet(
 
     base_style = {"border": border, "fill": fill}
 
+    set_status_func("テーブルの表示設定しています...")
+    setting_table_view(sheet, sheet_def, not is_need_thumb)
+
+    update_seq_func()
+
     row = sheet_def["TABLE_HEADER"]["row"]["pos"]
 
     set_status_func("テーブルのヘッダを設定しています...")
-    insert_table_header(sheet, row, sheet_def, base_style)
+    for _ in range(row - 1):
+        sheet.append([])
+    insert_table_header(sheet, sheet_def, base_style)
 
     update_seq_func()
 
@@ -225,21 +322,24 @@ def generate_list_sheet(
     else:
         cell_height = sheet_def["TABLE_HEADER"]["row"]["height"]["without_thumb"]
 
+    style_map = gen_item_cell_style_map(sheet_def, base_style)
+    image_cache = {}
+
     row += 1
     for item in item_list:
         sheet.row_dimensions[row].height = cell_height
-        insert_table_item(sheet, row, item, is_need_thumb, thumb_path_func(item), sheet_def, base_style)
+        insert_table_item(
+            sheet, row, item, is_need_thumb, thumb_path_func(item), sheet_def, style_map, image_cache
+        )
         update_item_func()
 
         row += 1
 
     row_last = row - 1
 
-    update_item_func()
     update_seq_func()
 
-    set_status_func("テーブルの表示設定しています...")
-    setting_table_view(sheet, sheet_def, row_last, not is_need_thumb)
+    setting_table_filter(sheet, sheet_def, row_last)
 
     update_seq_func()
 
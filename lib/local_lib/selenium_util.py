@@ -2,14 +2,19 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import email.message
+import functools
 import inspect
 import logging
 import os
 import random
 import subprocess
 import time
+import urllib.parse
 
-
+import lxml.etree
+import lxml.html
+import urllib3
 from selenium import webdriver
 from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.chrome.options import Options
@@ -21,6 +26,27 @@ from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.support import expected_conditions as EC
 
 WAIT_RETRY_COUNT = 1
+# NOTE: ブラウザを介さずにページを取得する際の HTTP のコネクションプールの大きさ
+HTTP_POOL_SIZE = 10
+HTTP_TIMEOUT_SEC = 30
+HTTP_DEFAULT_CHARSET = "utf-8"
+# NOTE: 巡回には不要なので読み込まないリソース．レイアウトが変わると要素の判定に影響するので，CSS は対象外
+BLOCK_URL_LIST = [
+    "*.jpg",
+    "*.jpeg",
+    "*.png",
+    "*.gif",
+    "*.webp",
+    "*.svg",
+    "*.woff",
+    "*.woff2",
+    "*.mp4",
+    "*googletagmanager*",
+    "*google-analytics*",
+    "*doubleclick*",
+]
+# NOTE: Network.setCookies に渡せる項目
+COOKIE_PARAM_KEY_LIST = ["name", "value", "domain", "path", "secure", "httpOnly", "sameSite", "expires"]
 AGENT_NAME = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36"
 
 
@@ -50,6 +76,9 @@ def create_driver_impl(profile_name, data_path, agent_name, is_headless):
 
     options.add_argument("user-agent={agent_name}".format(agent_name=agent_name))
 
+    # NOTE: 広告等の読み込み完了までは待たず，DOM の構築が終わった時点で制御を戻す
+    options.page_load_strategy = "eager"
+
     driver = webdriver.Chrome(
         service=Service(
             log_path=str(log_path / "webdriver.log"),
@@ -100,8 +129,87 @@ def xpath_exists(driver, xpath):
 
 
 def get_text(driver, xpath, safe_text):
-    if len(driver.find_elements(By.XPATH, xpath)) != 0:
-        return driver.find_element(By.XPATH, xpath).text.strip()
+    elem_list = driver.find_elements(By.XPATH, xpath)
+    if len(elem_list) != 0:
+        return elem_list[0].text.strip()
+    else:
+        return safe_text
+
+
+def parse_html_tree(html, base_url, encoding=None):
+    tree = lxml.html.fromstring(html, base_url=base_url, parser=lxml.html.HTMLParser(encoding=encoding))
+    tree.make_links_absolute(handle_failures="ignore")
+
+    return tree
+
+
+def get_html_tree(driver):
+    # NOTE: 要素毎に問い合わせるとその度に WebDriver との通信が発生するので，
+    # HTML をまとめて取得し，手元で解析する．
+    html, base_url = driver.execute_script("return [document.documentElement.outerHTML, document.baseURI]")
+
+    return parse_html_tree(html, base_url)
+
+
+def create_http_pool(pool_size=HTTP_POOL_SIZE):
+    return urllib3.PoolManager(maxsize=pool_size, block=False)
+
+
+def http_get(driver, http_pool, url, agent_name=AGENT_NAME):
+    # NOTE: ブラウザの Cookie を使って，ブラウザを介さずに取得する
+    cookie_list = driver.execute_cdp_cmd("Network.getCookies", {"urls": [url]})["cookies"]
+
+    headers = urllib3.make_headers(accept_encoding=True, user_agent=agent_name)
+    headers["Accept-Language"] = "ja,en-US;q=0.9,en;q=0.8"
+    headers["Cookie"] = "; ".join(
+        "{name}={value}".format(name=cookie["name"], value=cookie["value"]) for cookie in cookie_list
+    )
+
+    return http_pool.request("GET", url, headers=headers, timeout=HTTP_TIMEOUT_SEC)
+
+
+def http_get_ok(driver, http_pool, url, agent_name=AGENT_NAME):
+    try:
+        res = http_get(driver, http_pool, url, agent_name)
+    except urllib3.exceptions.HTTPError as e:
+        logging.warning("Failed to fetch {url}: {error}".format(url=url, error=e))
+        return None
+
+    if res.status != 200:
+        logging.warning("Failed to fetch {url}: status {status}".format(url=url, status=res.status))
+        return None
+
+    return res
+
+
+def get_html_tree_by_http(driver, http_pool, url, agent_name=AGENT_NAME):
+    res = http_get_ok(driver, http_pool, url, agent_name)
+    if res is None:
+        return None
+
+    # NOTE: meta タグで文字コードが宣言されていないページもあるので，レスポンスヘッダの指定を優先する
+    content_type = email.message.Message()
+    content_type["Content-Type"] = res.headers.get("Content-Type", "text/html")
+    encoding = content_type.get_content_charset(HTTP_DEFAULT_CHARSET)
+
+    # NOTE: リダイレクトされた場合，geturl() はパスのみを返すことがあるので，元の URL を基準に解決する
+    return parse_html_tree(res.data, urllib.parse.urljoin(url, res.geturl()), encoding)
+
+
+# NOTE: 同じ XPath をページや要素毎に何度も評価するので，コンパイル結果を使い回す
+@functools.lru_cache(maxsize=None)
+def compile_xpath(xpath):
+    return lxml.etree.XPath(xpath)
+
+
+def get_node_list(node, xpath):
+    return compile_xpath(xpath)(node)
+
+
+def get_node_text(node, xpath, safe_text=None):
+    node_list = get_node_list(node, xpath)
+    if len(node_list) != 0:
+        return " ".join(node_list[0].text_content().split())
     else:
         return safe_text
 
@@ -131,6 +239,43 @@ def is_display(driver, xpath):
     )
 
 
+def block_resource(driver, url_list=BLOCK_URL_LIST):
+    # NOTE: 現在のタブにのみ適用されるので，browser_tab で開いたタブでは画像も読み込まれる
+    driver.execute_cdp_cmd("Network.enable", {})
+    driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": url_list})
+
+
+def reload_image(driver, wait, elem):
+    driver.execute_script("arguments[0].src = arguments[0].src;", elem)
+    wait.until(
+        lambda driver: driver.execute_script(
+            "return arguments[0].complete && (arguments[0].naturalWidth != 0);", elem
+        )
+    )
+
+
+def copy_cookie(src_driver, dst_driver):
+    # NOTE: ブラウザ全体の Cookie を，ページを開かずにそのまま移す
+    cookie_list = []
+    for cookie in src_driver.execute_cdp_cmd("Network.getAllCookies", {})["cookies"]:
+        cookie_param = {key: cookie[key] for key in COOKIE_PARAM_KEY_LIST if key in cookie}
+        if cookie.get("session", False):
+            # NOTE: セッション Cookie は有効期限を指定せずに設定する
+            cookie_param.pop("expires", None)
+        cookie_list.append(cookie_param)
+
+    dst_driver.execute_cdp_cmd("Network.setCookies", {"cookies": cookie_list})
+
+
+def wait_for_ready(driver, wait, is_complete=True):
+    if is_complete:
+        state_list = ["complete"]
+    else:
+        state_list = ["interactive", "complete"]
+
+    wait.until(lambda driver: driver.execute_script("return document.readyState") in state_list)
+
+
 def random_sleep(sec):
     RATIO = 0.8
 
@@ -158,7 +303,9 @@ def wait_patiently(driver, wait, target):
 
 
 def dump_page(driver, index, dump_path):
-    name = inspect.stack()[1].function.replace("<", "").replace(">", "")
+    # NOTE: inspect.stack() は全フレームのソースを読むので，呼び出し元の情報だけを一度取得する
+    caller = inspect.getframeinfo(inspect.currentframe().f_back, context=0)
+    name = caller.function.replace("<", "").replace(">", "")
 
     dump_path.mkdir(parents=True, exist_ok=True)
 
@@ -173,9 +320,9 @@ def dump_page(driver, index, dump_path):
     logging.info(
         "page dump: {index:02d} from {func} in {file} line {line}".format(
             index=index,
-            func=inspect.stack()[1].function,
-            file=inspect.stack()[1].filename,
-            line=inspect.stack()[1].lineno,
+            func=caller.function,
+            file=caller.filename,
+            line=caller.lineno,
         )
     )
 
@@ -238,20 +385,53 @@ def warmup(driver, keyword, url_pattern):
     time.sleep(3)
 
 
+class Throttle:
+    # NOTE: 一定時間待つのではなく，失敗が続いた時だけ待ち時間を伸ばす
+    def __init__(self, base_sec=0.1, max_sec=2.0):
+        self.base_sec = base_sec
+        self.max_sec = max_sec
+        self.sec = base_sec
+
+    def wait(self, is_error=False):
+        if is_error:
+            self.sec = min(self.max_sec, self.sec * 2)
+        else:
+            self.sec = max(self.base_sec, self.sec / 2)
+
+        time.sleep(self.sec)
+
+
 class browser_tab:
-    def __init__(self, driver, url):
+    def __init__(self, driver, wait, url):
         self.driver = driver
+        self.wait = wait
         self.url = url
 
     def __enter__(self):
         self.driver.execute_script("window.open('{url}', '_blank');".format(url=self.url))
         self.driver.switch_to.window(self.driver.window_handles[-1])
-        time.sleep(0.1)
+
+        # NOTE: 一定時間待つのではなく，タブの読み込みが終わるのを待つ
+        try:
+            wait_for_ready(self.driver, self.wait)
+        except TimeoutException:
+            logging.warning("Tab is not ready: {url}".format(url=self.url))
 
     def __exit__(self, exception_type, exception_value, traceback):
         self.driver.close()
         self.driver.switch_to.window(self.driver.window_handles[-1])
-        time.sleep(0.1)
+
+
+class resource_unblocked:
+    def __init__(self, driver, url_list=BLOCK_URL_LIST):
+        self.driver = driver
+        self.url_list = url_list
+
+    def __enter__(self):
+        self.driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": []})
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": self.url_list})
 
 
 if __name__ == "__main__":
@@ -7,13 +7,82 @@ Usage:
   serializer.py
 """
 
+import datetime
 import logging
+import os
 import pathlib
 import pickle
+import struct
 import tempfile
 import traceback
-import shutil
-import os
+import zlib
+
+import msgpack
+import zstandard
+
+ZSTD_LEVEL = 3
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# NOTE: 末尾にデータ長と CRC32 を付けて，書き込み途中で壊れたファイルを検出する
+FOOTER_FORMAT = "<QI"
+FOOTER_SIZE = struct.calcsize(FOOTER_FORMAT)
+
+EXT_TYPE_DATETIME = 1
+EXT_TYPE_SET = 2
+
+
+def encode_ext(obj):
+    if isinstance(obj, datetime.datetime):
+        return msgpack.ExtType(EXT_TYPE_DATETIME, obj.isoformat().encode())
+    elif isinstance(obj, set):
+        return msgpack.ExtType(EXT_TYPE_SET, pack(list(obj)))
+    else:
+        raise TypeError("Unsupported type: {type}".format(type=type(obj)))
+
+
+def decode_ext(code, data):
+    if code == EXT_TYPE_DATETIME:
+        return datetime.datetime.fromisoformat(data.decode())
+    elif code == EXT_TYPE_SET:
+        return set(unpack(data))
+    else:
+        return msgpack.ExtType(code, data)
+
+
+def pack(data):
+    return msgpack.packb(data, default=encode_ext, use_bin_type=True)
+
+
+def unpack(buf):
+    return msgpack.unpackb(buf, ext_hook=decode_ext, raw=False, strict_map_key=False)
+
+
+def add_footer(payload):
+    return payload + struct.pack(FOOTER_FORMAT, len(payload), zlib.crc32(payload))
+
+
+def strip_footer(buf):
+    if len(buf) < FOOTER_SIZE:
+        raise ValueError("Data is too short")
+
+    size, crc = struct.unpack_from(FOOTER_FORMAT, buf, len(buf) - FOOTER_SIZE)
+    payload = memoryview(buf)[:-FOOTER_SIZE]
+
+    if (size != len(payload)) or (crc != zlib.crc32(payload)):
+        raise ValueError("Checksum mismatch")
+
+    return payload
+
+
+def load_file(file_path):
+    with open(file_path, "rb") as f:
+        buf = f.read()
+
+    if buf.startswith(ZSTD_MAGIC):
+        return unpack(zstandard.ZstdDecompressor().decompress(strip_footer(buf)))
+    else:
+        # NOTE: pickle で保存していた頃のファイル
+        return pickle.loads(buf)
 
 
 def store(file_path_str, data):
@@ -22,12 +91,12 @@ def store(file_path_str, data):
     file_path = pathlib.Path(file_path_str)
     try:
         f = tempfile.NamedTemporaryFile(dir=str(file_path.parent), delete=False)
-        pickle.dump(data, f)
+        f.write(add_footer(zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(pack(data))))
         f.close()
 
+        # NOTE: 壊れていた場合に備えて，ひとつ前の世代をリネームして残しておく
         if file_path.exists():
-            old_path = file_path.with_suffix(".old")
-            shutil.copy(file_path, old_path)
+            os.replace(file_path, file_path.with_suffix(".old"))
 
         os.replace(f.name, file_path)
     except:
@@ -37,17 +106,71 @@ def store(file_path_str, data):
 def load(file_path, init_value={}):
     logging.debug("Load {file_path}".format(file_path=file_path))
 
-    if not file_path.exists():
-        return init_value
+    # NOTE: store の途中で中断した場合，ひとつ前の世代しか残っていないことがあるので，
+    # ファイルが無くても .old を試す．
+    for path in [file_path, file_path.with_suffix(".old")]:
+        if not path.exists():
+            continue
 
-    try:
-        with open(file_path, "rb") as f:
+        try:
             data = init_value.copy()
-            data.update(pickle.load(f))
+            data.update(load_file(path))
             return data
-    except:
-        logging.error(traceback.format_exc())
-        return init_value
+        except:
+            logging.error(traceback.format_exc())
+            logging.warning("Failed to load {path}".format(path=path))
+
+    return init_value
+
+
+def append(file_path, data):
+    logging.debug("Append {file_path}".format(file_path=file_path))
+
+    # NOTE: 書き込めなかったことを呼び出し元が検知できるよう，例外はそのまま伝える
+    with open(file_path, "ab") as f:
+        f.write(pack(data))
+
+
+def load_all(file_path):
+    logging.debug("Load all {file_path}".format(file_path=file_path))
+
+    data_list = []
+    if not file_path.exists():
+        return data_list
+
+    with open(file_path, "r+b") as f:
+        unpacker = msgpack.Unpacker(f, ext_hook=decode_ext, raw=False, strict_map_key=False)
+        pos = 0
+        is_broken = False
+        try:
+            for data in unpacker:
+                data_list.append(data)
+                pos = unpacker.tell()
+        except:
+            logging.error(traceback.format_exc())
+            is_broken = True
+
+        if pos != os.fstat(f.fileno()).st_size:
+            if is_broken:
+                # NOTE: 途中のデータが壊れている場合，それ以降のデータを失わないよう，
+                # 切り詰める前に退避しておく．
+                broken_path = file_path.with_suffix(file_path.suffix + ".broken")
+                f.seek(pos)
+                with open(broken_path, "ab") as broken_file:
+                    broken_file.write(f.read())
+                logging.error(
+                    "Move broken data of {file_path} at {pos:,} to {broken_path}".format(
+                        file_path=file_path, pos=pos, broken_path=broken_path
+                    )
+                )
+            else:
+                # NOTE: 追記の途中で中断した場合，末尾のデータが途切れているので切り詰めておく
+                logging.warning(
+                    "Truncate incomplete data of {file_path} at {pos:,}".format(file_path=file_path, pos=pos)
+                )
+            f.truncate(pos)
+
+    return data_list
 
 
 if __name__ == "__main__":
@@ -58,7 +181,7 @@ if __name__ == "__main__":
 
     logger.init("test", level=logging.INFO)
 
-    data = {"a": 1.0}
+    data = {"a": 1.0, "b": datetime.datetime.now(), "c": {1, 2}}
 
     f = tempfile.NamedTemporaryFile()
     file_path = pathlib.Path(f.name)
@@ -66,3 +189,23 @@ if __name__ == "__main__":
     f.flush()
 
     assert load(file_path) == data
+
+    store(file_path, data)
+    with open(file_path, "r+b") as broken_file:
+        broken_file.truncate(os.fstat(broken_file.fileno()).st_size - 1)
+
+    # NOTE: 壊れている場合はひとつ前の世代が読まれる
+    assert load(file_path) == data
+
+    # NOTE: 世代を入れ替える途中で中断した場合も，ひとつ前の世代が読まれる
+    store(file_path, data)
+    os.replace(file_path, file_path.with_suffix(".old"))
+    assert load(file_path) == data
+    os.replace(file_path.with_suffix(".old"), file_path)
+
+    log_path = file_path.with_suffix(".log")
+    append(log_path, data)
+    append(log_path, data)
+
+    assert load_all(log_path) == [data, data]
+    log_path.unlink()
@@ -15,18 +15,18 @@ Options:
 """
 
 import re
-import math
 import datetime
-import random
 import logging
 import inspect
-import time
 import traceback
-import platform
+import queue
+import concurrent.futures
+import io
 
+import PIL.Image
+from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.common.by import By
-from selenium.webdriver.common.action_chains import ActionChains
-from selenium.webdriver.common.keys import Keys
+from selenium.webdriver.support import expected_conditions as EC
 
 import local_lib.selenium_util
 import store_amazon.const
@@ -43,11 +43,117 @@ FETCH_RETRY_COUNT = 1
 DEBUG_USE_DUMP = False
 DEBUG_DUMP = True
 
+PRICE_RE = re.compile(r"\d{1,3}(?:,\d{3})*")
+YEAR_RE = re.compile(r"\d+年")
+SIGNIN_RE = re.compile(r"Amazonサインイン")
+NUM_RE = re.compile(r"(\d+)")
+# NOTE: strptime は書式の解釈から毎回行うので遅い．書式は固定なので正規表現で切り出す．
+DATE_RE = re.compile(r"(\d+)年(\d+)月(\d+)日")
+DATE_DIGITAL_RE = re.compile(r"(\d+)/(\d+)/(\d+)")
+ASIN_RE = re.compile(r"/gp/product/([^/]+)/")
+ASIN_DIGITAL_RE = re.compile(r"/dp/([^/]+)/")
+
+ROBOT_CHECK_XPATH = '//form[contains(@action, "validateCaptcha")]'
+ORDER_DETAIL_XPATH = '//div[contains(@data-component, "shipments")] | //b[contains(text(), "デジタル注文")]'
+ORDER_XPATH = '//div[contains(@class, "order-card js-order-card")]'
+ORDER_COUNT_XPATH = "//span[contains(@class, 'num-orders')]"
+# NOTE: 注文か注文数のどちらかがあれば，注文の一覧のページとみなす
+ORDER_LIST_XPATH = ORDER_XPATH + " | " + ORDER_COUNT_XPATH
+BREADCRUMB_XPATH = "//div[contains(@class, 'a-breadcrumb')]//li//a"
+
+
+# NOTE: ページ側のスクリプトが入力を検知できるよう，値を設定した後にイベントを発生させる
+LOGIN_FILL_SCRIPT = """
+const fill = (elem, value) => {
+    elem.value = value;
+    elem.dispatchEvent(new Event("input", { bubbles: true }));
+    elem.dispatchEvent(new Event("change", { bubbles: true }));
+};
+"""
+
+# NOTE: メールアドレスを入力して「次へ」を押した場合は true を返す
+LOGIN_EMAIL_SCRIPT = (
+    LOGIN_FILL_SCRIPT
+    + """
+const email = document.querySelector('input#ap_email:not([type="hidden"])');
+const next = document.querySelector("input#continue");
+if ((email === null) || (next === null)) return false;
+
+fill(email, arguments[0]);
+next.click();
+return true;
+"""
+)
+
+# NOTE: パスワードを入力して「ログイン」を押した場合は true を返す
+LOGIN_PASS_SCRIPT = (
+    LOGIN_FILL_SCRIPT
+    + """
+const submit = document.querySelector("input#signInSubmit");
+if (submit === null) return false;
+
+const pass = document.querySelector("input#ap_password");
+if (pass !== null) fill(pass, arguments[0]);
+
+const remember = document.querySelector('input[name="rememberMe"]');
+if ((remember !== null) && !remember.checked) remember.click();
+
+submit.click();
+return true;
+"""
+)
+
+
+class AmazhistError(RuntimeError):
+    pass
+
 
-def wait_for_loading(handle, sec=2):
+class CaptchaError(AmazhistError):
+    pass
+
+
+class LoginError(AmazhistError):
+    pass
+
+
+# NOTE: 一定時間待つのではなく，ページの読み込みが終わるのを待つ．
+# 必要な情報は HTML に含まれているので，画像等の読み込み完了までは待たない．
+def wait_for_loading(handle):
+    driver, wait = store_amazon.handle.get_selenium_driver(handle)
+
+    local_lib.selenium_util.wait_for_ready(driver, wait, is_complete=False)
+
+
+def wait_for(handle, xpath):
     driver, wait = store_amazon.handle.get_selenium_driver(handle)
 
-    time.sleep(sec)
+    try:
+        wait.until(EC.presence_of_element_located((By.XPATH, xpath)))
+        return True
+    except TimeoutException:
+        logging.warning("Element is not found: {xpath}".format(xpath=xpath))
+        return False
+
+
+def wait_for_page_change(handle, html_elem):
+    driver, wait = store_amazon.handle.get_selenium_driver(handle)
+
+    # NOTE: 遷移前のページで読み込み完了と判定しないよう，ページが切り替わるのを待つ
+    try:
+        wait.until(EC.staleness_of(html_elem))
+    except TimeoutException:
+        logging.warning("Page is not changed")
+
+    wait_for_loading(handle)
+
+
+def click_and_wait(handle, elem):
+    driver, wait = store_amazon.handle.get_selenium_driver(handle)
+
+    html_elem = driver.find_element(By.XPATH, "/html")
+    elem.click()
+
+    wait_for_page_change(handle, html_elem)
 
 
 def resolve_captcha(handle):
@@ -60,61 +166,46 @@ def resolve_captcha(handle):
             logging.info("Retry to resolve CAPTCHA")
 
         captcha_img_path = store_amazon.handle.get_captcha_file_path(handle)
-        captcha_png_data = driver.find_element(By.XPATH, '//img[@alt="captcha"]').screenshot_as_png
+        captcha_img_elem = driver.find_element(By.XPATH, '//img[@alt="captcha"]')
+        # NOTE: 画像の読み込みを止めている間に表示された場合に備えて，読み込み直す
+        local_lib.selenium_util.reload_image(driver, wait, captcha_img_elem)
 
         logging.info("Save image: {path}".format(path=captcha_img_path))
 
-        with open(captcha_img_path, "wb") as f:
-            f.write(captcha_png_data)
+        captcha_img_path.write_bytes(captcha_img_elem.screenshot_as_png)
 
         captcha_text = input("「{img_file}」に書かれているテキストを入力してくだい: ".format(img_file=captcha_img_path))
 
         driver.find_element(By.XPATH, '//input[@name="cvf_captcha_input"]').send_keys(captcha_text.strip())
-        driver.find_element(By.XPATH, '//input[@type="submit"]').click()
-
-        wait_for_loading(handle)
+        click_and_wait(handle, driver.find_element(By.XPATH, '//input[@type="submit"]'))
 
         if len(driver.find_elements(By.XPATH, '//input[@name="cvf_captcha_input"]')) == 0:
             return
 
         logging.warning("Failed to resolve CAPTCHA")
         local_lib.selenium_util.dump_page(
-            driver, int(random.random() * 100), store_amazon.handle.get_debug_dir_path(handle)
+            driver, store_amazon.handle.get_dump_index(handle), store_amazon.handle.get_debug_dir_path(handle)
         )
-        time.sleep(1)
 
     logging.error("Give up to resolve CAPTCHA")
-    raise "画像認証を解決できませんでした．"
+    raise CaptchaError("画像認証を解決できませんでした．")
 
 
 def execute_login(handle):
     driver, wait = store_amazon.handle.get_selenium_driver(handle)
 
-    time.sleep(1)
-
-    if len(driver.find_elements(By.XPATH, '//input[@id="ap_email" and @type!="hidden"]')) != 0:
-        driver.find_element(By.XPATH, '//input[@id="ap_email"]').clear()
-        driver.find_element(By.XPATH, '//input[@id="ap_email"]').send_keys(
-            store_amazon.handle.get_login_user(handle)
-        )
-
-        if len(driver.find_elements(By.XPATH, '//input[@id="continue"]')) != 0:
-            driver.find_element(By.XPATH, '//input[@id="continue"]').click()
-            wait_for_loading(handle)
-
-    if len(driver.find_elements(By.XPATH, '//input[@id="ap_password"]')) != 0:
-        driver.find_element(By.XPATH, '//input[@id="ap_password"]').clear()
-        driver.find_element(By.XPATH, '//input[@id="ap_password"]').send_keys(
-            store_amazon.handle.get_login_pass(handle)
-        )
+    wait_for(handle, '//input[@id="ap_email" or @id="ap_password"]')
 
-    if len(driver.find_elements(By.XPATH, '//input[@id="rememberMe"]')) != 0:
-        if not driver.find_element(By.XPATH, '//input[@name="rememberMe"]').get_attribute("checked"):
-            driver.find_element(By.XPATH, '//input[@name="rememberMe"]').click()
+    # NOTE: 要素毎に操作するとその度に WebDriver との通信が発生するので，入力から送信までをまとめて行う
+    html_elem = driver.find_element(By.XPATH, "/html")
+    if driver.execute_script(LOGIN_EMAIL_SCRIPT, store_amazon.handle.get_login_user(handle)):
+        wait_for_page_change(handle, html_elem)
+        html_elem = driver.find_element(By.XPATH, "/html")
 
-    driver.find_element(By.XPATH, '//input[@id="signInSubmit"]').click()
-
-    wait_for_loading(handle)
+    if driver.execute_script(LOGIN_PASS_SCRIPT, store_amazon.handle.get_login_pass(handle)):
+        wait_for_page_change(handle, html_elem)
+    else:
+        logging.warning("Sign-in button is not found")
 
     if len(driver.find_elements(By.XPATH, '//input[@name="cvf_captcha_input"]')) != 0:
         resolve_captcha(handle)
@@ -123,39 +214,42 @@ def execute_login(handle):
 def keep_logged_on(handle):
     driver, wait = store_amazon.handle.get_selenium_driver(handle)
 
-    if not re.match("Amazonサインイン", driver.title):
+    if not SIGNIN_RE.match(driver.title):
         return
 
     logging.info("Try to login")
 
-    for i in range(LOGIN_RETRY_COUNT):
-        if i != 0:
-            logging.info("Retry to login")
+    # NOTE: 並列に巡回している場合に，画像認証の入力待ちが重ならないようにする．
+    # また，画像認証の画像が表示されるよう，ログイン中はリソースの読み込みを止めない．
+    with handle["login_lock"], local_lib.selenium_util.resource_unblocked(driver):
+        for i in range(LOGIN_RETRY_COUNT):
+            if i != 0:
+                logging.info("Retry to login")
 
-        execute_login(handle)
+            execute_login(handle)
 
-        if not re.match("Amazonサインイン", driver.title):
-            logging.info("Login sccessful!")
-            return
+            if not SIGNIN_RE.match(driver.title):
+                logging.info("Login sccessful!")
+                return
 
-        logging.warning("Failed to login")
-        local_lib.selenium_util.dump_page(
-            driver, int(random.random() * 100), store_amazon.handle.get_debug_dir_path(handle)
-        )
+            logging.warning("Failed to login")
+            local_lib.selenium_util.dump_page(
+                driver,
+                store_amazon.handle.get_dump_index(handle),
+                store_amazon.handle.get_debug_dir_path(handle),
+            )
 
     logging.error("Give up to login")
-    raise "ログインに失敗しました．"
+    raise LoginError("ログインに失敗しました．")
 
 
 def gen_hist_url(year, page):
+    start = store_amazon.const.ORDER_COUNT_PER_PAGE * (page - 1)
+
     if year == store_amazon.const.ARCHIVE_LABEL:
-        return store_amazon.const.HIST_URL_IN_ARCHIVE.format(
-            start=store_amazon.const.ORDER_COUNT_PER_PAGE * (page - 1)
-        )
+        return f"{store_amazon.const.HIST_URL}?timeFilter=archived&startIndex={start}"
     else:
-        return store_amazon.const.HIST_URL_BY_YEAR.format(
-            year=year, start=store_amazon.const.ORDER_COUNT_PER_PAGE * (page - 1)
-        )
+        return f"{store_amazon.const.HIST_URL}?timeFilter=year-{year}&startIndex={start}"
 
 
 def gen_order_url(no):
@@ -166,7 +260,7 @@ def gen_target_text(year):
     if year == store_amazon.const.ARCHIVE_LABEL:
         return "Archive"
     else:
-        return "Year {year}".format(year=year)
+        return f"Year {year}"
 
 
 def gen_status_label_by_yeart(year):
@@ -180,24 +274,67 @@ def visit_url(handle, url, file_name):
     wait_for_loading(handle)
 
 
+def fetch_html_tree(handle, url, expect_xpath=None):
+    driver, wait = store_amazon.handle.get_selenium_driver(handle)
+
+    # NOTE: 注文履歴のページはサーバ側で生成されているので，ブラウザで描画せずに HTML だけ取得する
+    tree = local_lib.selenium_util.get_html_tree_by_http(
+        driver, store_amazon.handle.get_http_pool(handle), url
+    )
+
+    # NOTE: 取得できなかった場合や画像認証を求められた場合は，アクセスを控えるよう求められている
+    # 可能性が高いので，間隔を広げる．
+    is_error = (tree is None) or (len(local_lib.selenium_util.get_node_list(tree, ROBOT_CHECK_XPATH)) != 0)
+    if is_error:
+        store_amazon.handle.get_throttle(handle).wait(is_error=True)
+
+    # NOTE: ログインや画像認証を求められた場合や，期待した内容が無い場合は，ブラウザで開いて対処する
+    if (
+        is_error
+        or SIGNIN_RE.match((tree.findtext(".//title") or "").strip())
+        or (
+            (expect_xpath is not None)
+            and (len(local_lib.selenium_util.get_node_list(tree, expect_xpath)) == 0)
+        )
+    ):
+        visit_url(handle, url, inspect.currentframe().f_code.co_name)
+        keep_logged_on(handle)
+
+        if expect_xpath is not None:
+            wait_for(handle, expect_xpath)
+
+        tree = local_lib.selenium_util.get_html_tree(driver)
+
+    return tree
+
+
+def parse_date_by_re(date_re, date_text):
+    m = date_re.match(date_text)
+    if m is None:
+        raise ValueError("Unexpected date format: {date_text}".format(date_text=date_text))
+
+    return datetime.datetime(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+
+
 def parse_date(date_text):
-    return datetime.datetime.strptime(date_text, "%Y年%m月%d日")
+    return parse_date_by_re(DATE_RE, date_text)
 
 
 def parse_date_digital(date_text):
-    return datetime.datetime.strptime(date_text, "%Y/%m/%d")
+    return parse_date_by_re(DATE_DIGITAL_RE, date_text)
 
 
-def parse_item_giftcard(handle, item_xpath):
-    driver, wait = store_amazon.handle.get_selenium_driver(handle)
+def parse_price(price_text):
+    return int(PRICE_RE.search(price_text).group(0).replace(",", ""))
 
+
+def parse_item_giftcard(handle, item_elem):
     count = 1
 
-    price_text = driver.find_element(
-        By.XPATH,
-        item_xpath + "//div[contains(@class, 'gift-card-instance')]/div[contains(@class, 'a-column')][1]",
-    ).text
-    price = int(re.match(r".*?(\d{1,3}(?:,\d{3})*)", price_text).group(1).replace(",", ""))
+    price_text = local_lib.selenium_util.get_node_text(
+        item_elem, ".//div[contains(@class, 'gift-card-instance')]/div[contains(@class, 'a-column')][1]"
+    )
+    price = parse_price(price_text)
 
     seller = "アマゾンジャパン合同会社"
     condition = "新品"
@@ -211,29 +348,27 @@ def parse_item_giftcard(handle, item_xpath):
     }
 
 
-def parse_item_default(handle, item_xpath):
-    driver, wait = store_amazon.handle.get_selenium_driver(handle)
-
+def parse_item_default(handle, item_elem):
     count = int(
-        local_lib.selenium_util.get_text(
-            driver, item_xpath + '/..//span[contains(@class, "item-view-qty")]', "1"
-        )
+        local_lib.selenium_util.get_node_text(item_elem, "..//span[contains(@class, 'item-view-qty')]", "1")
     )
 
-    price_text = driver.find_element(By.XPATH, item_xpath + "//span[contains(@class, 'a-color-price')]").text
-    price = int(re.match(r".*?(\d{1,3}(?:,\d{3})*)", price_text).group(1).replace(",", ""))
+    price_text = local_lib.selenium_util.get_node_text(
+        item_elem, ".//span[contains(@class, 'a-color-price')]"
+    )
+    price = parse_price(price_text)
     price *= count
 
-    seller = local_lib.selenium_util.get_text(
-        driver,
-        item_xpath + "//span[contains(@class, 'a-size-small') and contains(text(), '販売:')]",
+    seller = local_lib.selenium_util.get_node_text(
+        item_elem,
+        ".//span[contains(@class, 'a-size-small') and contains(text(), '販売:')]",
         " アマゾンジャパン合同会社",
     ).split(" ", 2)[1]
 
-    condition = local_lib.selenium_util.get_text(
-        driver,
-        item_xpath
-        + "//span[contains(@class, 'a-color-secondary') and contains(text(), 'コンディション：')]/following-sibling::span[1]",
+    condition = local_lib.selenium_util.get_node_text(
+        item_elem,
+        ".//span[contains(@class, 'a-color-secondary') and contains(text(), 'コンディション：')]"
+        + "/following-sibling::span[1]",
         "新品",
     )
 
@@ -246,54 +381,53 @@ def parse_item_default(handle, item_xpath):
     }
 
 
-def fetch_item_category(handle, item_link):
-    driver, wait = store_amazon.handle.get_selenium_driver(handle)
-
-    actions = ActionChains(driver)
-
-    if platform.system() == "Darwin":
-        actions.key_down(Keys.COMMAND)
-    else:
-        actions.key_down(Keys.CONTROL)
+def fetch_item_category(handle, item_url):
+    # NOTE: パンくずリストを読むだけなので，タブを開いて描画を待たずに HTML を取得する
+    tree = fetch_html_tree(handle, item_url)
 
-    actions.click(item_link)
-    actions.perform()
+    return [
+        " ".join(breadcrumb.text_content().split())
+        for breadcrumb in local_lib.selenium_util.get_node_list(tree, BREADCRUMB_XPATH)
+    ]
 
-    driver.switch_to.window(driver.window_handles[-1])
 
-    breadcrumb_list = driver.find_elements(By.XPATH, "//div[contains(@class, 'a-breadcrumb')]//li//a")
-    category = list(map(lambda x: x.text, breadcrumb_list))
+def get_item_category(handle, asin, item_url):
+    category = store_amazon.handle.get_item_category(handle, asin)
+    if category is not None:
+        return category
 
-    time.sleep(1)
-    driver.close()
-    driver.switch_to.window(driver.window_handles[0])
+    store_amazon.handle.get_throttle(handle).wait()
 
-    return category
+    return fetch_item_category(handle, item_url)
 
 
 def save_thumbnail(handle, item, thumb_url):
     driver, wait = store_amazon.handle.get_selenium_driver(handle)
+    thumb_path = store_amazon.handle.get_thumb_path(handle, item)
 
-    with local_lib.selenium_util.browser_tab(driver, thumb_url):
-        png_data = driver.find_element(By.XPATH, "//img").screenshot_as_png
-
-        with open(store_amazon.handle.get_thumb_path(handle, item), "wb") as f:
-            f.write(png_data)
+    # NOTE: ブラウザで表示してスクリーンショットを撮るのではなく，画像を直接ダウンロードする
+    res = local_lib.selenium_util.http_get_ok(driver, store_amazon.handle.get_http_pool(handle), thumb_url)
+    if res is None:
+        store_amazon.handle.get_throttle(handle).wait(is_error=True)
+    else:
+        try:
+            with PIL.Image.open(io.BytesIO(res.data)) as img:
+                img.save(thumb_path, "PNG")
+            return
+        except OSError as e:
+            logging.warning("Failed to decode thumbnail {url}: {error}".format(url=thumb_url, error=e))
 
+    with local_lib.selenium_util.browser_tab(driver, wait, thumb_url):
+        thumb_path.write_bytes(driver.find_element(By.XPATH, "//img").screenshot_as_png)
 
-def parse_item(handle, item_xpath):
-    driver, wait = store_amazon.handle.get_selenium_driver(handle)
 
-    link = driver.find_element(
-        By.XPATH,
-        item_xpath + "//a[contains(@class, 'a-link-normal')]",
-    )
-    name = link.text
-    url = link.get_attribute("href")
-    asin = re.match(r".*/gp/product/([^/]+)/", url).group(1)
+def parse_item(handle, item_elem):
+    link = local_lib.selenium_util.get_node_list(item_elem, ".//a[contains(@class, 'a-link-normal')]")[0]
+    name = " ".join(link.text_content().split())
+    url = link.get("href")
+    asin = ASIN_RE.search(url).group(1)
 
-    time.sleep(0.5)
-    category = fetch_item_category(handle, link)
+    category = get_item_category(handle, asin, url)
 
     item = {
         "name": name,
@@ -302,44 +436,43 @@ def parse_item(handle, item_xpath):
         "category": category,
     }
 
-    thumb_url = driver.find_element(By.XPATH, item_xpath + "/preceding-sibling::div//a/img").get_attribute(
-        "src"
-    )
-    save_thumbnail(handle, item, thumb_url)
+    thumb_elem = local_lib.selenium_util.get_node_list(item_elem, "./preceding-sibling::div//a/img")[0]
+    save_thumbnail(handle, item, thumb_elem.get("src"))
 
-    if len(driver.find_elements(By.XPATH, item_xpath + "//div[contains(@class, 'gift-card-instance')]")) != 0:
-        return item | parse_item_giftcard(handle, item_xpath)
+    gift_card_elem_list = local_lib.selenium_util.get_node_list(
+        item_elem, ".//div[contains(@class, 'gift-card-instance')]"
+    )
+    if len(gift_card_elem_list) != 0:
+        return item | parse_item_giftcard(handle, item_elem)
     else:
-        return item | parse_item_default(handle, item_xpath)
+        return item | parse_item_default(handle, item_elem)
 
 
-def parse_order_digital(handle, order_info):
-    driver, wait = store_amazon.handle.get_selenium_driver(handle)
-
-    date_text = driver.find_element(By.XPATH, '//td/b[contains(text(), "デジタル注文")]').text.split()[1]
+def parse_order_digital(handle, order_info, tree):
+    date_text = local_lib.selenium_util.get_node_text(tree, '//td/b[contains(text(), "デジタル注文")]').split()[1]
     date = parse_date_digital(date_text)
 
-    no = driver.find_element(By.XPATH, '//ul/li/b[contains(text(), "注文番号")]/..').text.split(": ")[1]
+    no = local_lib.selenium_util.get_node_text(tree, '//ul/li/b[contains(text(), "注文番号")]/..').split(": ")[1]
 
     item_xpath = "//tr[td[b[contains(text(), '注文商品')]]]/following-sibling::tr[1]"
 
-    if len(driver.find_elements(By.XPATH, item_xpath + "/td[1]//a")) != 0:
-        link = driver.find_element(By.XPATH, item_xpath + "/td[1]//a")
-        name = link.text
-        url = link.get_attribute("href")
-        asin = re.match(r".*/dp/([^/]+)/", url).group(1)
-        category = fetch_item_category(handle, link)
+    link_list = local_lib.selenium_util.get_node_list(tree, item_xpath + "/td[1]//a")
+    if len(link_list) != 0:
+        name = " ".join(link_list[0].text_content().split())
+        url = link_list[0].get("href")
+        asin = ASIN_DIGITAL_RE.search(url).group(1)
+        category = get_item_category(handle, asin, url)
     else:
         # NOTE: もう販売ページが存在しない場合．
-        name = driver.find_element(By.XPATH, item_xpath + "/td[1]//b").text
+        name = local_lib.selenium_util.get_node_text(tree, item_xpath + "/td[1]//b")
         url = None
         asin = None
         category = []
 
     count = 1
 
-    price_text = driver.find_element(By.XPATH, item_xpath + "/td[2]").text
-    price = int(re.match(r".*?(\d{1,3}(?:,\d{3})*)", price_text).group(1).replace(",", ""))
+    price_text = local_lib.selenium_util.get_node_text(tree, item_xpath + "/td[2]")
+    price = parse_price(price_text)
 
     seller = "アマゾンジャパン合同会社"
     condition = "新品"
@@ -361,24 +494,23 @@ def parse_order_digital(handle, order_info):
         "order_page": order_info["page"],
     }
 
-    logging.info("{name} {price:,}円".format(name=item["name"], price=item["price"]))
-
-    store_amazon.handle.record_item(handle, item)
+    if logging.root.isEnabledFor(logging.INFO):
+        logging.info("{name} {price:,}円".format(name=item["name"], price=item["price"]))
 
-    return True
+    return [item]
 
 
-def parse_order_default(handle, order_info):
+def parse_order_default(handle, order_info, tree):
     ITEM_XPATH = '//div[contains(@data-component, "shipments")]//div[contains(@class, "yohtmlc-item")]'
 
-    driver, wait = store_amazon.handle.get_selenium_driver(handle)
-
-    date_text = driver.find_element(
-        By.XPATH, '//span[contains(@class, "order-date-invoice-item")][1]'
-    ).text.split()[1]
+    date_text = local_lib.selenium_util.get_node_text(
+        tree, '//span[contains(@class, "order-date-invoice-item")][1]'
+    ).split()[1]
     date = parse_date(date_text)
 
-    no = driver.find_element(By.XPATH, '//span[contains(@class, "order-date-invoice-item")]/bdi').text
+    no = local_lib.selenium_util.get_node_text(
+        tree, '//span[contains(@class, "order-date-invoice-item")]/bdi'
+    )
 
     item_base = {
         "date": date,
@@ -387,85 +519,76 @@ def parse_order_default(handle, order_info):
         "order_page": order_info["page"],
     }
 
-    is_unempty = False
-    for i in range(len(driver.find_elements(By.XPATH, ITEM_XPATH))):
-        item_xpath = "(" + ITEM_XPATH + ")[{index}]".format(index=i + 1)
-
-        item = parse_item(handle, item_xpath)
+    item_list = []
+    for item_elem in local_lib.selenium_util.get_node_list(tree, ITEM_XPATH):
+        item = parse_item(handle, item_elem)
         item |= item_base
 
-        logging.info("{name} {price:,}円".format(name=item["name"], price=item["price"]))
-
-        store_amazon.handle.record_item(handle, item)
-        is_unempty = True
+        if logging.root.isEnabledFor(logging.INFO):
+            logging.info("{name} {price:,}円".format(name=item["name"], price=item["price"]))
 
-    return is_unempty
+        item_list.append(item)
 
+    return item_list
 
-def parse_order(handle, order_info):
-    driver, wait = store_amazon.handle.get_selenium_driver(handle)
 
-    logging.info(
-        "Parse order: {date} - {no}".format(date=order_info["date"].strftime("%Y-%m-%d"), no=order_info["no"])
-    )
+def parse_order(handle, order_info, tree):
+    logging.info("Parse order: %s - %s", order_info["date"].date(), order_info["no"])
 
-    if len(driver.find_elements(By.XPATH, "//b[contains(text(), 'デジタル注文')]")) != 0:
-        is_unempty = parse_order_digital(handle, order_info)
+    if len(local_lib.selenium_util.get_node_list(tree, "//b[contains(text(), 'デジタル注文')]")) != 0:
+        return parse_order_digital(handle, order_info, tree)
     else:
-        is_unempty = parse_order_default(handle, order_info)
-
-    return is_unempty
+        return parse_order_default(handle, order_info, tree)
 
 
 def parse_order_count(handle, year):
-    ORDER_COUNT_XPATH = "//span[contains(@class, 'num-orders')]"
-    ORDER_XPATH = '//div[contains(@class, "order-card js-order-card")]'
-
-    driver, wait = store_amazon.handle.get_selenium_driver(handle)
-
     # NOTE: 注文数が多い場合，実際の注文数は最初の方のページには表示されないので，
     # あり得ないページ数を指定する．
-    visit_url(handle, gen_hist_url(year, 10000), inspect.currentframe().f_code.co_name)
+    tree = fetch_html_tree(handle, gen_hist_url(year, 10000))
 
-    if local_lib.selenium_util.xpath_exists(driver, ORDER_COUNT_XPATH):
-        order_count_text = driver.find_element(By.XPATH, ORDER_COUNT_XPATH).text
+    order_count_text = local_lib.selenium_util.get_node_text(tree, ORDER_COUNT_XPATH)
+    if order_count_text is not None:
+        return int(NUM_RE.match(order_count_text).group(1))
 
-        return int(re.match(r"(\d+)", order_count_text).group(1))
-    else:
-        time.sleep(1)
+    store_amazon.handle.get_throttle(handle).wait()
+
+    # NOTE: 注文数が表示されない場合，注文数が少ない可能性が高いので，先頭のページを表示する．
+    # 要素を一度だけ列挙して，その数を注文数とする．
+    order_count = len(
+        local_lib.selenium_util.get_node_list(
+            fetch_html_tree(handle, gen_hist_url(year, 1), ORDER_LIST_XPATH), ORDER_XPATH
+        )
+    )
+    if order_count == 0:
+        logging.warning("Failed to get order count.")
 
-        # NOTE: 注文数が表示されない場合，注文数が少ない可能性が高いので，先頭のページを表示する．
-        visit_url(handle, gen_hist_url(year, 1), inspect.currentframe().f_code.co_name)
+    return order_count
 
-        if local_lib.selenium_util.xpath_exists(driver, ORDER_XPATH):
-            logging.info(int(driver.find_elements(By.XPATH, ORDER_XPATH)))
-            return int(driver.find_elements(By.XPATH, ORDER_XPATH))
-        else:
-            logging.warning("Failed to get order count.")
-            return 0
 
+def fetch_order_item_list_by_order_info(handle, order_info, retry=0):
+    # NOTE: 注文の詳細ページは一度だけ取得し，以降は手元で解析する
+    tree = fetch_html_tree(handle, order_info["url"], ORDER_DETAIL_XPATH)
 
-def fetch_order_item_list_by_order_info(handle, order_info):
-    visit_url(handle, order_info["url"], inspect.currentframe().f_code.co_name)
-    keep_logged_on(handle)
+    item_list = parse_order(handle, order_info, tree)
+    if len(item_list) == 0:
+        logging.warning("Failed to parse order of %s", order_info["no"])
+        store_amazon.handle.get_throttle(handle).wait(is_error=True)
+
+        if retry < FETCH_RETRY_COUNT:
+            logging.warning("Try retying...")
+            return fetch_order_item_list_by_order_info(handle, order_info, retry + 1)
 
-    if not parse_order(handle, order_info):
-        logging.warning("Failed to parse order of {no}".format(no=order_info["no"]))
-        time.sleep(1)
         return False
 
-    return True
+    # NOTE: 途中で中断した注文が取得済みと扱われないよう，注文の全商品を揃えてから記録する
+    store_amazon.handle.record_order(handle, item_list)
 
+    return True
 
-def fetch_order_item_list_by_year_page(handle, year, page, retry=0):
-    ORDER_XPATH = '//div[contains(@class, "order-card js-order-card")]'
 
+def fetch_order_item_list_by_year_page(handle, year, page, total_page, retry=0):
     driver, wait = store_amazon.handle.get_selenium_driver(handle)
 
-    total_page = math.ceil(
-        store_amazon.handle.get_order_count(handle, year) / store_amazon.const.ORDER_COUNT_PER_PAGE
-    )
-
     store_amazon.handle.set_status(
         handle,
         "注文履歴を解析しています... {target} {page}/{total_page} ページ".format(
@@ -473,70 +596,70 @@ def fetch_order_item_list_by_year_page(handle, year, page, retry=0):
         ),
     )
 
-    visit_url(handle, gen_hist_url(year, page), inspect.currentframe().f_code.co_name)
-    keep_logged_on(handle)
+    url = gen_hist_url(year, page)
+    # NOTE: 注文の一覧ではないページを注文が無いページと誤認しないよう，一覧の要素を確認する
+    tree = fetch_html_tree(handle, url, ORDER_LIST_XPATH)
 
-    logging.info(
-        "Check order of {year} page {page}/{total_page}".format(year=year, page=page, total_page=total_page)
-    )
-    logging.info("URL: {url}".format(url=driver.current_url))
+    logging.info("Check order of %s page %d/%d", year, page, total_page)
+    logging.info("URL: %s", url)
 
     is_skipped = False
-    order_list = []
-    for i in range(len(driver.find_elements(By.XPATH, ORDER_XPATH))):
-        order_xpath = ORDER_XPATH + "[{index}]".format(index=i + 1)
+    order_elem_list = local_lib.selenium_util.get_node_list(tree, ORDER_XPATH)
 
-        if (
-            len(
-                driver.find_elements(
-                    By.XPATH, '//div[contains(@class, "a-alert-content")]//span[contains(text(), "問題が発生")]'
-                )
+    if (len(order_elem_list) != 0) and (
+        len(
+            local_lib.selenium_util.get_node_list(
+                tree, '//div[contains(@class, "a-alert-content")]//span[contains(text(), "問題が発生")]'
             )
-            != 0
-        ):
-            if retry < FETCH_RETRY_COUNT:
-                logging.warning("Something went wrong. Try retying...")
-                time.sleep(1)
-                return fetch_order_item_list_by_year_page(handle, year, page, retry=0)
-            else:
-                continue
-
-        date_text = driver.find_element(
-            By.XPATH, order_xpath + "//div[contains(@class, 'a-row')]/span[contains(@class, 'value')]"
-        ).text
-        date = parse_date(date_text)
-
-        no = driver.find_element(
-            By.XPATH,
-            order_xpath + "//div[contains(@class, 'yohtmlc-order-id')]/span[contains(@class, 'value')]",
-        ).text
-
-        url = driver.find_element(
-            By.XPATH, order_xpath + "//a[contains(@class, 'yohtmlc-order-details-link')]"
-        ).get_attribute("href")
+        )
+        != 0
+    ):
+        if retry < FETCH_RETRY_COUNT:
+            logging.warning("Something went wrong. Try retying...")
+            store_amazon.handle.get_throttle(handle).wait(is_error=True)
+            return fetch_order_item_list_by_year_page(handle, year, page, total_page, retry + 1)
+        else:
+            # NOTE: 次回の実行時に取得し直すよう，このページは未取得のままにしておく
+            logging.warning("Give up to check order of %s page %d", year, page)
+            order_elem_list = []
+            is_skipped = True
 
-        order_list.append({"date": date, "no": no, "url": url, "time_filter": year, "page": page})
+    store_amazon.handle.get_throttle(handle).wait()
 
-    time.sleep(1)
+    year_bar_desc = gen_status_label_by_yeart(year)
+    for order_elem in order_elem_list:
+        no = local_lib.selenium_util.get_node_text(
+            order_elem, ".//div[contains(@class, 'yohtmlc-order-id')]/span[contains(@class, 'value')]"
+        )
 
-    for order_info in order_list:
-        if not store_amazon.handle.get_order_stat(handle, order_info["no"]):
+        # NOTE: 取得済みの注文が大半なので，注文番号で判定してから他の項目を取り出す
+        if not store_amazon.handle.get_order_stat(handle, no):
+            date_text = local_lib.selenium_util.get_node_text(
+                order_elem, ".//div[contains(@class, 'a-row')]/span[contains(@class, 'value')]"
+            )
+            url = local_lib.selenium_util.get_node_list(
+                order_elem, ".//a[contains(@class, 'yohtmlc-order-details-link')]"
+            )[0].get("href")
+
+            order_info = {
+                "date": parse_date(date_text),
+                "no": no,
+                "url": url,
+                "time_filter": year,
+                "page": page,
+            }
             is_skipped |= not fetch_order_item_list_by_order_info(handle, order_info)
         else:
-            logging.info(
-                "Done order: {date} - {no} [cached]".format(
-                    date=order_info["date"].strftime("%Y-%m-%d"), no=order_info["no"]
-                )
-            )
-        store_amazon.handle.get_progress_bar(handle, gen_status_label_by_yeart(year)).update()
-        store_amazon.handle.get_progress_bar(handle, STATUS_ORDER_ITEM_ALL).update()
+            logging.info("Done order: %s [cached]", no)
+        store_amazon.handle.update_progress_bar(handle, year_bar_desc)
+        store_amazon.handle.update_progress_bar(handle, STATUS_ORDER_ITEM_ALL)
 
         if year in [datetime.datetime.now().year, store_amazon.const.ARCHIVE_LABEL]:
             last_item = store_amazon.handle.get_last_item(handle, year)
             if (
                 store_amazon.handle.get_year_checked(handle, year)
                 and (last_item != None)
-                and (last_item["no"] == order_info["no"])
+                and (last_item["no"] == no)
             ):
                 logging.info("Latest order found, skipping analysis of subsequent pages")
                 for i in range(total_page):
@@ -548,36 +671,36 @@ def fetch_order_item_list_by_year_page(handle, year, page, retry=0):
 def fetch_year_list(handle):
     driver, wait = store_amazon.handle.get_selenium_driver(handle)
 
+    # NOTE: 過去の年が増減することは無いので，前回の一覧に今年と非表示にした注文が含まれていれば，
+    # ドロップダウンを開かずにそれを使う．非表示にした注文は後から現れることがあるので，
+    # 含まれていない場合は毎回確認する．
+    year_list = store_amazon.handle.get_year_list(handle)
+    if (datetime.datetime.now().year in year_list) and (store_amazon.const.ARCHIVE_LABEL in year_list):
+        logging.info("Use cached year list")
+        return year_list
+
     visit_url(handle, store_amazon.const.HIST_URL, inspect.currentframe().f_code.co_name)
 
     keep_logged_on(handle)
 
+    # NOTE: ドロップダウンはスクリプトで動くので，読み込みが完全に終わるのを待つ
+    try:
+        local_lib.selenium_util.wait_for_ready(driver, wait)
+    except TimeoutException:
+        logging.warning("Order history page is not ready")
+
     driver.find_element(
         By.XPATH, "//form[@action='/your-orders/orders']//span[contains(@class, 'a-dropdown-prompt')]"
     ).click()
 
-    wait_for_loading(handle)
+    wait_for(handle, "//div[contains(@class, 'a-popover-wrapper')]//li")
 
-    year_str_list = list(
-        map(
-            lambda elem: elem.text,
-            driver.find_elements(
-                By.XPATH,
-                "//div[contains(@class, 'a-popover-wrapper')]//li",
-            ),
-        )
-    )
+    year_str_list = [
+        elem.text
+        for elem in driver.find_elements(By.XPATH, "//div[contains(@class, 'a-popover-wrapper')]//li")
+    ]
 
-    year_list = list(
-        reversed(
-            list(
-                map(
-                    lambda label: int(label.replace("年", "")),
-                    filter(lambda label: re.match(r"\d+年", label), year_str_list),
-                )
-            )
-        )
-    )
+    year_list = [int(label[:-1]) for label in year_str_list if YEAR_RE.fullmatch(label)][::-1]
 
     if "非表示にした注文" in year_str_list:
         year_list.append(store_amazon.const.ARCHIVE_LABEL)
@@ -588,24 +711,21 @@ def fetch_year_list(handle):
 
 
 def skip_order_item_list_by_year_page(handle, year, page):
-    logging.info("Skip check order of {year} page {page} [cached]".format(year=year, page=page))
+    logging.info("Skip check order of %s page %d [cached]", year, page)
     incr_order = min(
         store_amazon.handle.get_order_count(handle, year)
         - store_amazon.handle.get_progress_bar(handle, gen_status_label_by_yeart(year)).count,
         store_amazon.const.ORDER_COUNT_PER_PAGE,
     )
-    store_amazon.handle.get_progress_bar(handle, gen_status_label_by_yeart(year)).update(incr_order)
-    store_amazon.handle.get_progress_bar(handle, STATUS_ORDER_ITEM_ALL).update(incr_order)
+    store_amazon.handle.update_progress_bar(handle, gen_status_label_by_yeart(year), incr_order)
+    store_amazon.handle.update_progress_bar(handle, STATUS_ORDER_ITEM_ALL, incr_order)
 
     # NOTE: これ，状況によっては最終ページで成り立たないので，良くない
     return incr_order != store_amazon.const.ORDER_COUNT_PER_PAGE
 
 
 def fetch_order_item_list_by_year(handle, year, start_page=1):
-    visit_url(handle, gen_hist_url(year, start_page), inspect.currentframe().f_code.co_name)
-
-    keep_logged_on(handle)
-
+    # NOTE: 一覧のページは fetch_html_tree で取得し，ログインが必要な場合もそこでブラウザを使って対処する
     year_list = store_amazon.handle.get_year_list(handle)
 
     logging.info(
@@ -620,17 +740,22 @@ def fetch_order_item_list_by_year(handle, year, start_page=1):
         store_amazon.handle.get_order_count(handle, year),
     )
 
+    # NOTE: 注文数は fetch_order_count で取得済みなので，ページ数は年毎に一度だけ求める
+    total_page = -(
+        -store_amazon.handle.get_order_count(handle, year) // store_amazon.const.ORDER_COUNT_PER_PAGE
+    )
+
     page = start_page
     is_skipped = False
     while True:
         if not store_amazon.handle.get_page_checked(handle, year, page):
-            is_skipped_page, is_last = fetch_order_item_list_by_year_page(handle, year, page)
+            is_skipped_page, is_last = fetch_order_item_list_by_year_page(handle, year, page, total_page)
 
             if not is_skipped_page:
                 store_amazon.handle.set_page_checked(handle, year, page)
 
             is_skipped |= is_skipped_page
-            time.sleep(1)
+            store_amazon.handle.get_throttle(handle).wait(is_skipped_page)
         else:
             is_last = skip_order_item_list_by_year_page(handle, year, page)
 
@@ -641,7 +766,8 @@ def fetch_order_item_list_by_year(handle, year, start_page=1):
 
         page += 1
 
-    store_amazon.handle.get_progress_bar(handle, gen_status_label_by_yeart(year)).update()
+    store_amazon.handle.update_progress_bar(handle, gen_status_label_by_yeart(year))
+    store_amazon.handle.flush_progress_bar(handle, gen_status_label_by_yeart(year))
 
     if not is_skipped:
         store_amazon.handle.set_year_checked(handle, year)
@@ -686,6 +812,64 @@ def fetch_order_count(handle):
     store_amazon.handle.store_order_info(handle)
 
 
+def fetch_order_item_list_by_year_worker(worker_queue, year):
+    worker_handle = worker_queue.get()
+    try:
+        fetch_order_item_list_by_year(worker_handle, year)
+    except Exception:
+        driver, wait = store_amazon.handle.get_selenium_driver(worker_handle)
+        local_lib.selenium_util.dump_page(
+            driver,
+            store_amazon.handle.get_dump_index(worker_handle),
+            store_amazon.handle.get_debug_dir_path(worker_handle),
+        )
+        raise
+    finally:
+        worker_queue.put(worker_handle)
+
+
+def fetch_order_item_list_by_year_list(handle, year_list):
+    worker_count = min(store_amazon.handle.get_worker_count(handle), len(year_list))
+
+    if worker_count <= 1:
+        for year in year_list:
+            fetch_order_item_list_by_year(handle, year)
+        return
+
+    logging.info("Check order with {count} browsers".format(count=worker_count))
+
+    # NOTE: 年毎に別のブラウザで並列に巡回する．1つ目のブラウザは既存のものを使う．
+    worker_handle_list = [handle] + [
+        store_amazon.handle.create_worker_handle(handle, i) for i in range(1, worker_count)
+    ]
+    worker_queue = queue.Queue()
+    for worker_handle in worker_handle_list:
+        worker_queue.put(worker_handle)
+
+    try:
+        # NOTE: 各ブラウザで改めてログインしなくて済むよう，ログイン済みの Cookie を引き継ぐ
+        driver, wait = store_amazon.handle.get_selenium_driver(handle)
+        for worker_handle in worker_handle_list[1:]:
+            worker_driver, worker_wait = store_amazon.handle.get_selenium_driver(worker_handle)
+            local_lib.selenium_util.copy_cookie(driver, worker_driver)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=worker_count) as executor:
+            future_list = [
+                executor.submit(fetch_order_item_list_by_year_worker, worker_queue, year)
+                for year in year_list
+            ]
+            try:
+                for future in future_list:
+                    future.result()
+            except:
+                for future in future_list:
+                    future.cancel()
+                raise
+    finally:
+        for worker_handle in worker_handle_list[1:]:
+            store_amazon.handle.quit_selenium_driver(worker_handle)
+
+
 def fetch_order_item_list_all_year(handle):
     driver, wait = store_amazon.handle.get_selenium_driver(handle)
 
@@ -696,6 +880,7 @@ def fetch_order_item_list_all_year(handle):
         handle, STATUS_ORDER_ITEM_ALL, store_amazon.handle.get_total_order_count(handle)
     )
 
+    target_year_list = []
     for year in year_list:
         if (
             (year == datetime.datetime.now().year)
@@ -703,7 +888,7 @@ def fetch_order_item_list_all_year(handle):
             or (type(year) is str)
             or (not store_amazon.handle.get_year_checked(handle, year))
         ):
-            fetch_order_item_list_by_year(handle, year)
+            target_year_list.append(year)
         else:
             logging.info(
                 "Done order of {year} ({year_index}/{total_year}) [cached]".format(
@@ -714,6 +899,8 @@ def fetch_order_item_list_all_year(handle):
                 store_amazon.handle.get_order_count(handle, year)
             )
 
+    fetch_order_item_list_by_year_list(handle, target_year_list)
+
     store_amazon.handle.get_progress_bar(handle, STATUS_ORDER_ITEM_ALL).update()
 
 
@@ -725,9 +912,9 @@ def fetch_order_item_list(handle):
 
     try:
         fetch_order_item_list_all_year(handle)
-    except:
+    except Exception:
         local_lib.selenium_util.dump_page(
-            driver, int(random.random() * 100), store_amazon.handle.get_debug_dir_path(handle)
+            driver, store_amazon.handle.get_dump_index(handle), store_amazon.handle.get_debug_dir_path(handle)
         )
         raise
 
@@ -750,10 +937,12 @@ if __name__ == "__main__":
     try:
         if args["-n"] is not None:
             no = args["-n"]
-            visit_url(handle, gen_order_url(no), inspect.currentframe().f_code.co_name)
-            keep_logged_on(handle)
+            tree = fetch_html_tree(handle, gen_order_url(no), ORDER_DETAIL_XPATH)
 
-            parse_order(handle, {"date": datetime.datetime.now(), "no": no, "page": 1, "time_filter": None})
+            # NOTE: 動作確認用なので，解析結果はキャッシュに記録しない
+            parse_order(
+                handle, {"date": datetime.datetime.now(), "no": no, "page": 1, "time_filter": None}, tree
+            )
         elif args["-y"] is None:
             fetch_order_item_list(handle)
         else:
@@ -767,9 +956,9 @@ if __name__ == "__main__":
             store_amazon.handle.set_progress_bar(handle, STATUS_ORDER_ITEM_ALL, count)
 
             fetch_order_item_list_by_year(handle, year, start_page)
-    except:
+    except Exception:
         driver, wait = store_amazon.handle.get_selenium_driver(handle)
         logging.error(traceback.format_exc())
         local_lib.selenium_util.dump_page(
-            driver, int(random.random() * 100), store_amazon.handle.get_debug_dir_path(handle)
+            driver, store_amazon.handle.get_dump_index(handle), store_amazon.handle.get_debug_dir_path(handle)
         )
@@ -1,23 +1,72 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import pathlib
-import functools
+import bisect
 import enlighten
 import datetime
+import copy
+import functools
+import itertools
+import threading
+import time
 
-from selenium.webdriver.support.wait import WebDriverWait
 import openpyxl.styles
 
 import store_amazon.const
 import local_lib.serializer
-import local_lib.selenium_util
+
+# NOTE: 追記形式で別ファイルに保存するデータ
+ITEM_KEY_LIST = ["item_list", "order_no_stat"]
+
+# NOTE: 追記ファイルには，キー名を毎回書き出さずに済むよう，この順で値だけを並べた配列として保存する．
+# 項目を増やす場合は末尾に追加すること．
+ITEM_FIELD_LIST = [
+    "date",
+    "no",
+    "name",
+    "url",
+    "asin",
+    "count",
+    "price",
+    "category",
+    "seller",
+    "condition",
+    "kind",
+    "order_time_filter",
+    "order_page",
+]
+
+# NOTE: 管理データの書き出しは，この時間だけ更新が無かった時にまとめて行う
+STORE_DELAY_SEC = 2
+
+# NOTE: プログレスバーの更新は，この件数か時間が溜まった時にまとめて反映する
+PROGRESS_UPDATE_COUNT = 16
+PROGRESS_UPDATE_SEC = 0.25
+
+# NOTE: 同時に使用するブラウザの数の既定値
+WORKER_COUNT = 1
+
+PROGRESS_BAR_FORMAT = (
+    "{desc:31s}{desc_pad}{percentage:3.0f}% |{bar}| {count:5d} / {total:5d} "
+    + "[{elapsed}<{eta}, {rate:6.2f}{unit_pad}{unit}/s]"
+)
+PROGRESS_COUNTER_FORMAT = (
+    "{desc:30s}{desc_pad}{count:5d} {unit}{unit_pad}[{elapsed}, {rate:6.2f}{unit_pad}{unit}/s]{fill}"
+)
 
 
 def create(config):
     handle = {
         "progress_manager": enlighten.get_manager(),
         "progress_bar": {},
+        "progress_pending": {},
         "config": config,
+        "order_store": {"lock": threading.Lock(), "timer": None, "data": None},
+        "sorted_item_list": None,
+        "dump_index": itertools.count(1),
+        # NOTE: 複数のブラウザで並列に巡回する際に，共有しているデータを守る
+        "lock": threading.RLock(),
+        "login_lock": threading.Lock(),
     }
 
     load_order_info(handle)
@@ -50,60 +99,137 @@ def get_excel_font(handle):
     return openpyxl.styles.Font(name=font_config["name"], size=font_config["size"])
 
 
+# NOTE: 商品毎に何度も呼ばれるので，Path の生成結果をキャッシュしておく
+@functools.lru_cache(maxsize=None)
+def gen_path(base_dir, path, suffix=None):
+    if suffix is None:
+        return pathlib.Path(base_dir, path)
+    else:
+        return pathlib.Path(base_dir, path).with_suffix(suffix)
+
+
 def get_caceh_file_path(handle):
-    return pathlib.Path(handle["config"]["base_dir"], handle["config"]["data"]["amazon"]["cache"]["order"])
+    return gen_path(handle["config"]["base_dir"], handle["config"]["data"]["amazon"]["cache"]["order"])
+
+
+def get_item_log_file_path(handle):
+    return gen_path(
+        handle["config"]["base_dir"], handle["config"]["data"]["amazon"]["cache"]["order"], ".log"
+    )
 
 
 def get_excel_file_path(handle):
-    return pathlib.Path(handle["config"]["base_dir"], handle["config"]["output"]["excel"]["table"])
+    return gen_path(handle["config"]["base_dir"], handle["config"]["output"]["excel"]["table"])
 
 
 def get_thumb_dir_path(handle):
-    return pathlib.Path(handle["config"]["base_dir"], handle["config"]["data"]["amazon"]["cache"]["thumb"])
+    return gen_path(handle["config"]["base_dir"], handle["config"]["data"]["amazon"]["cache"]["thumb"])
 
 
 def get_selenium_data_dir_path(handle):
-    return pathlib.Path(handle["config"]["base_dir"], handle["config"]["data"]["selenium"])
+    return gen_path(handle["config"]["base_dir"], handle["config"]["data"]["selenium"])
 
 
 def get_debug_dir_path(handle):
-    return pathlib.Path(handle["config"]["base_dir"], handle["config"]["data"]["debug"])
+    return gen_path(handle["config"]["base_dir"], handle["config"]["data"]["debug"])
 
 
 def get_captcha_file_path(handle):
-    return pathlib.Path(handle["config"]["base_dir"], handle["config"]["output"]["captcha"])
+    return gen_path(handle["config"]["base_dir"], handle["config"]["output"]["captcha"])
+
+
+def get_worker_count(handle):
+    return handle["config"].get("crawl", {}).get("worker", WORKER_COUNT)
+
+
+def create_worker_handle(handle, index):
+    # NOTE: 後から作られると共有されないので，ソート済みの商品リストは先に作っておく
+    get_item_list(handle)
+
+    # NOTE: 管理データやプログレスバーは共有し，ブラウザだけを別のプロファイルで用意する
+    worker_handle = {key: value for key, value in handle.items() if key != "selenium"}
+    worker_handle["selenium_profile"] = "Amazhist_{index}".format(index=index)
+
+    return worker_handle
 
 
 def get_selenium_driver(handle):
     if "selenium" in handle:
         return (handle["selenium"]["driver"], handle["selenium"]["wait"])
     else:
-        driver = local_lib.selenium_util.create_driver("Amazhist", get_selenium_data_dir_path(handle))
-        wait = WebDriverWait(driver, 5)
+        # NOTE: Excel の出力のみ行う場合は不要なので，ここで import する
+        from selenium.webdriver.support.wait import WebDriverWait
+        import local_lib.selenium_util
 
-        local_lib.selenium_util.clear_cache(driver)
+        driver = local_lib.selenium_util.create_driver(
+            handle.get("selenium_profile", "Amazhist"), get_selenium_data_dir_path(handle)
+        )
+        local_lib.selenium_util.block_resource(driver)
+        wait = WebDriverWait(driver, 5)
 
         handle["selenium"] = {
             "driver": driver,
             "wait": wait,
+            "throttle": local_lib.selenium_util.Throttle(),
+            "http_pool": local_lib.selenium_util.create_http_pool(),
         }
 
         return (driver, wait)
 
 
-def record_item(handle, item):
-    handle["order"]["item_list"].append(item)
-    handle["order"]["order_no_stat"][item["no"]] = True
+def get_throttle(handle):
+    get_selenium_driver(handle)
+
+    return handle["selenium"]["throttle"]
+
+
+def get_http_pool(handle):
+    get_selenium_driver(handle)
+
+    return handle["selenium"]["http_pool"]
+
+
+def record_order(handle, item_list):
+    with handle["lock"]:
+        # NOTE: 注文の途中で中断した場合に，一部の商品だけが記録されて注文が取得済みと
+        # 扱われないよう，注文単位でひとつのレコードとして追記する．
+        # また，書き込みに失敗した場合は例外になるので，取得済みとして扱う前に追記する．
+        local_lib.serializer.append(get_item_log_file_path(handle), pack_order(item_list))
+
+        for item in item_list:
+            handle["order"]["item_list"].append(item)
+            handle["order"]["order_no_stat"].add(item["no"])
+            cache_item_category(handle, item)
+
+            if handle["sorted_item_list"] is not None:
+                bisect.insort(handle["sorted_item_list"], item, key=lambda x: x["date"])
+
+
+def pack_item(item):
+    return [item.get(key) for key in ITEM_FIELD_LIST]
+
+
+def pack_order(item_list):
+    return [pack_item(item) for item in item_list]
+
+
+def unpack_order(data):
+    return [dict(zip(ITEM_FIELD_LIST, item)) for item in data]
 
 
 def get_item_list(handle):
-    return sorted(handle["order"]["item_list"], key=lambda x: x["date"])
+    if handle["sorted_item_list"] is None:
+        handle["sorted_item_list"] = sorted(handle["order"]["item_list"], key=lambda x: x["date"])
+
+    return handle["sorted_item_list"]
 
 
 def get_last_item(handle, time_filter):
-    return next(
-        filter(lambda item: item["order_time_filter"] == time_filter, reversed(get_item_list(handle))), None
-    )
+    with handle["lock"]:
+        return next(
+            filter(lambda item: item["order_time_filter"] == time_filter, reversed(get_item_list(handle))),
+            None,
+        )
 
 
 def get_thumb_path(handle, item):
@@ -113,6 +239,16 @@ def get_thumb_path(handle, item):
         return get_thumb_dir_path(handle) / (item["asin"] + ".png")
 
 
+def cache_item_category(handle, item):
+    # NOTE: 取得に失敗して空だった場合は，次に出てきた時に取得し直す
+    if item.get("asin") and item.get("category"):
+        handle["category_cache"][item["asin"]] = item["category"]
+
+
+def get_item_category(handle, asin):
+    return handle["category_cache"].get(asin)
+
+
 def get_order_stat(handle, no):
     return no in handle["order"]["order_no_stat"]
 
@@ -134,7 +270,7 @@ def get_order_count(handle, year):
 
 
 def get_total_order_count(handle):
-    return functools.reduce(lambda a, b: a + b, handle["order"]["year_count"].values())
+    return sum(handle["order"]["year_count"].values())
 
 
 def get_year_list(handle):
@@ -142,56 +278,113 @@ def get_year_list(handle):
 
 
 def set_progress_bar(handle, desc, total):
-    BAR_FORMAT = (
-        "{desc:31s}{desc_pad}{percentage:3.0f}% |{bar}| {count:5d} / {total:5d} "
-        + "[{elapsed}<{eta}, {rate:6.2f}{unit_pad}{unit}/s]"
-    )
-    COUNTER_FORMAT = (
-        "{desc:30s}{desc_pad}{count:5d} {unit}{unit_pad}[{elapsed}, {rate:6.2f}{unit_pad}{unit}/s]{fill}"
-    )
+    with handle["lock"]:
+        flush_progress_bar(handle, desc)
 
-    handle["progress_bar"][desc] = handle["progress_manager"].counter(
-        total=total, desc=desc, bar_format=BAR_FORMAT, counter_format=COUNTER_FORMAT
-    )
+        handle["progress_bar"][desc] = handle["progress_manager"].counter(
+            total=total, desc=desc, bar_format=PROGRESS_BAR_FORMAT, counter_format=PROGRESS_COUNTER_FORMAT
+        )
+        handle["progress_pending"][desc] = {"count": 0, "time": time.time()}
 
 
-def set_status(handle, status, is_error=False):
-    if is_error:
-        color = "bold_bright_white_on_red"
-    else:
-        color = "bold_bright_white_on_lightslategray"
-
-    if "status" not in handle:
-        handle["status"] = handle["progress_manager"].status_bar(
-            status_format="アマゾン{fill}{status}{fill}{elapsed}",
-            color=color,
-            justify=enlighten.Justify.CENTER,
-            status=status,
-        )
-    else:
-        handle["status"].color = color
-        handle["status"].update(status=status, force=True)
+def update_progress_bar(handle, desc, incr=1):
+    with handle["lock"]:
+        pending = handle["progress_pending"][desc]
+        pending["count"] += incr
 
+        if (pending["count"] >= PROGRESS_UPDATE_COUNT) or (
+            (time.time() - pending["time"]) > PROGRESS_UPDATE_SEC
+        ):
+            flush_progress_bar(handle, desc)
 
-def finish(handle):
+
+def flush_progress_bar(handle, desc):
+    with handle["lock"]:
+        pending = handle["progress_pending"].get(desc)
+        if (pending is None) or (pending["count"] == 0):
+            return
+
+        handle["progress_bar"][desc].update(pending["count"])
+        pending["count"] = 0
+        pending["time"] = time.time()
+
+
+def set_status(handle, status, is_error=False):
+    with handle["lock"]:
+        if is_error:
+            color = "bold_bright_white_on_red"
+        else:
+            color = "bold_bright_white_on_lightslategray"
+
+        if "status" not in handle:
+            handle["status"] = handle["progress_manager"].status_bar(
+                status_format="アマゾン{fill}{status}{fill}{elapsed}",
+                color=color,
+                justify=enlighten.Justify.CENTER,
+                status=status,
+            )
+        else:
+            handle["status"].color = color
+            handle["status"].update(status=status, force=True)
+
+
+def quit_selenium_driver(handle):
     if "selenium" in handle:
         handle["selenium"]["driver"].quit()
         handle.pop("selenium")
 
+
+def finish(handle):
+    flush_order_info(handle)
+
+    for desc in handle["progress_pending"].keys():
+        flush_progress_bar(handle, desc)
+
+    quit_selenium_driver(handle)
+
     handle["progress_manager"].stop()
 
 
 def store_order_info(handle):
-    handle["order"]["last_modified"] = datetime.datetime.now()
+    with handle["lock"]:
+        handle["order"]["last_modified"] = datetime.datetime.now()
+
+        # NOTE: 商品の情報は record_order で追記済みなので，管理データのみ書き出す
+        data = copy.deepcopy(
+            {key: value for key, value in handle["order"].items() if key not in ITEM_KEY_LIST}
+        )
+
+    order_store = handle["order_store"]
+    with order_store["lock"]:
+        order_store["data"] = data
+
+        if order_store["timer"] is not None:
+            order_store["timer"].cancel()
+
+        order_store["timer"] = threading.Timer(STORE_DELAY_SEC, flush_order_info, args=(handle,))
+        order_store["timer"].start()
 
-    local_lib.serializer.store(get_caceh_file_path(handle), handle["order"])
+
+def flush_order_info(handle):
+    order_store = handle["order_store"]
+    with order_store["lock"]:
+        if order_store["timer"] is not None:
+            order_store["timer"].cancel()
+            order_store["timer"] = None
+
+        if order_store["data"] is None:
+            return
+
+        local_lib.serializer.store(get_caceh_file_path(handle), order_store["data"])
+        order_store["data"] = None
 
 
 def set_page_checked(handle, year, page):
-    if year in handle["order"]["page_stat"]:
-        handle["order"]["page_stat"][year][page] = True
-    else:
-        handle["order"]["page_stat"][year] = {page: True}
+    with handle["lock"]:
+        if year in handle["order"]["page_stat"]:
+            handle["order"]["page_stat"][year][page] = True
+        else:
+            handle["order"]["page_stat"][year] = {page: True}
 
 
 def get_page_checked(handle, year, page):
@@ -202,8 +395,9 @@ def get_page_checked(handle, year, page):
 
 
 def set_year_checked(handle, year):
-    handle["order"]["year_stat"][year] = True
-    store_order_info(handle)
+    with handle["lock"]:
+        handle["order"]["year_stat"].add(year)
+        store_order_info(handle)
 
 
 def get_year_checked(handle, year):
@@ -216,14 +410,37 @@ def load_order_info(handle):
         {
             "year_list": [],
             "year_count": {},
-            "year_stat": {},
+            "year_stat": set(),
             "page_stat": {},
             "item_list": [],
-            "order_no_stat": {},
+            "order_no_stat": set(),
             "last_modified": datetime.datetime(1994, 7, 5),
         },
     )
 
+    item_log_file_path = get_item_log_file_path(handle)
+    if item_log_file_path.exists():
+        handle["order"]["item_list"] = [
+            item for data in local_lib.serializer.load_all(item_log_file_path) for item in unpack_order(data)
+        ]
+        handle["order"]["order_no_stat"] = {item["no"] for item in handle["order"]["item_list"]}
+    else:
+        # NOTE: 商品の情報をまとめて保存していた頃のキャッシュなので，注文単位の追記形式に移行する
+        order_map = {}
+        for item in handle["order"]["item_list"]:
+            order_map.setdefault(item["no"], []).append(item)
+        for item_list in order_map.values():
+            local_lib.serializer.append(item_log_file_path, pack_order(item_list))
+        handle["order"]["order_no_stat"] = set(handle["order"]["order_no_stat"])
+
+    # NOTE: 同じ商品を何度も購入している場合に，カテゴリを取得し直さずに済むようにする
+    handle["category_cache"] = {}
+    for item in handle["order"]["item_list"]:
+        cache_item_category(handle, item)
+
+    # NOTE: 年毎の状態を辞書で保存していた頃のキャッシュの場合，集合に変換する
+    handle["order"]["year_stat"] = set(handle["order"]["year_stat"])
+
     # NOTE: 再開した時には巡回すべきなので削除しておく
     for time_filter in [
         datetime.datetime.now().year,
@@ -234,5 +451,13 @@ def load_order_info(handle):
             del handle["order"]["page_stat"][time_filter]
 
 
+def get_dump_index(handle):
+    # NOTE: ダンプが上書きされないよう，通し番号を振る (並列に巡回するブラウザ間でも共有する)
+    return next(handle["dump_index"])
+
+
 def get_progress_bar(handle, desc):
+    # NOTE: 溜まっている更新を反映してから返す
+    flush_progress_bar(handle, desc)
+
     return handle["progress_bar"][desc]
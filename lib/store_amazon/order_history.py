@@ -23,7 +23,7 @@ import openpyxl.drawing.spreadsheet_drawing
 
 import local_lib.openpyxl_util
 import store_amazon.handle
-import store_amazon.crawler
+import store_amazon.const
 
 STATUS_INSERT_ITEM = "[generate] Insert item"
 STATUS_ALL = "[generate] Excel file"
@@ -103,7 +103,8 @@ SHEET_DEF = {
                 "pos": 13,
                 "width": 28,
                 "format": "@",
-                "link_func": lambda item: store_amazon.crawler.gen_order_url(item["no"]),
+                # NOTE: Selenium を読み込まずに済むよう，crawler は使わずに URL を組み立てる
+                "link_func": lambda item: store_amazon.const.HIST_URL_BY_ORDER_NO.format(no=item["no"]),
             },
         },
     },
@@ -123,8 +124,9 @@ def generate_sheet(handle, book, is_need_thumb=True):
         lambda item: store_amazon.handle.get_thumb_path(handle, item),
         lambda status: store_amazon.handle.set_status(handle, status),
         lambda: store_amazon.handle.get_progress_bar(handle, STATUS_ALL).update(),
-        lambda: store_amazon.handle.get_progress_bar(handle, STATUS_INSERT_ITEM).update(),
+        lambda: store_amazon.handle.update_progress_bar(handle, STATUS_INSERT_ITEM),
     )
+    store_amazon.handle.flush_progress_bar(handle, STATUS_INSERT_ITEM)
 
 
 def generate_table_excel(handle, excel_file, is_need_thumb=True):
@@ -133,15 +135,13 @@ def generate_table_excel(handle, excel_file, is_need_thumb=True):
 
     logging.info("Start to Generate excel file")
 
-    book = openpyxl.Workbook()
+    book = openpyxl.Workbook(write_only=True)
     book._named_styles["Normal"].font = store_amazon.handle.get_excel_font(handle)
 
     store_amazon.handle.get_progress_bar(handle, STATUS_ALL).update()
 
     generate_sheet(handle, book, is_need_thumb)
 
-    book.remove(book.worksheets[0])
-
     store_amazon.handle.set_status(handle, "エクセルファイルを書き出しています...")
 
     book.save(excel_file)